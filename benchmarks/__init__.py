@@ -0,0 +1,8 @@
+"""Offline benchmarks of the wps_tools helpers
+
+Synthetic netCDF, json and rda files are served by a local HTTP file server
+and a stand-in OPeNDAP server that only answers with DAP headers, so that
+network helpers can be measured without any online resource. Run with
+
+    python -m benchmarks --help
+"""
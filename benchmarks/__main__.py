@@ -0,0 +1,80 @@
+"""Command line entry point of the benchmarks"""
+# Library imports
+import os
+import sys
+import argparse
+from tempfile import mkdtemp
+
+# Tool imports
+from benchmarks.harness import report, save_baseline, load_baseline
+from benchmarks.servers import serve
+from benchmarks.suites import Context, benchmarks, cleanup
+
+
+def parse_size(value):
+    """Parse a size such as 512, 64K or 10M into bytes"""
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    value = value.strip().upper().rstrip("B")
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks", description=__doc__.splitlines()[0]
+    )
+    parser.add_argument("--count", type=int, default=20, help="files per benchmark")
+    parser.add_argument(
+        "--size", type=parse_size, default="1M", help="size of each file, e.g. 64K"
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="timed calls")
+    parser.add_argument("--workers", type=int, default=8, help="parallel workers")
+    parser.add_argument(
+        "--only",
+        default=",".join(benchmarks),
+        help=f"comma separated benchmarks among {', '.join(benchmarks)}",
+    )
+    parser.add_argument("--save", metavar="PATH", help="store results as a baseline")
+    parser.add_argument("--compare", metavar="PATH", help="baseline to compare to")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="relative increase of median latency reported as a regression",
+    )
+    args = parser.parse_args(argv)
+
+    names = [name.strip() for name in args.only.split(",") if name.strip()]
+    unknown = set(names) - set(benchmarks)
+    if unknown:
+        parser.error(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+
+    # Downloads are only cached where a benchmark asks for it
+    os.environ.pop("WPS_TOOLS_CACHE_DIR", None)
+
+    directory = mkdtemp(prefix="wps_tools_bench_")
+    results = []
+    with serve(directory) as base_url:
+        ctx = Context(
+            directory, base_url, args.count, args.size, args.repeat, args.workers
+        )
+        try:
+            for name in names:
+                results.extend(benchmarks[name](ctx))
+        finally:
+            cleanup(ctx)
+
+    baseline = load_baseline(args.compare) if args.compare else None
+    regressions = report(results, baseline, args.threshold)
+    if args.save:
+        save_baseline(args.save, results, vars(args))
+
+    if regressions:
+        print(f"Regressions: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
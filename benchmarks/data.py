@@ -0,0 +1,54 @@
+"""Synthetic input and output files for the benchmarks"""
+# Library imports
+import os
+import json
+import numpy
+from netCDF4 import Dataset
+
+
+def make_netcdf(path, size):
+    """Write a netCDF4 file holding about size bytes of float64 data"""
+    length = max(size // 8, 1)
+    with Dataset(path, "w") as dataset:
+        dataset.createDimension("time", length)
+        time = dataset.createVariable("time", "f8", ("time",))
+        time.units = "days since 1950-01-01"
+        time[:] = numpy.arange(length)
+        pr = dataset.createVariable("pr", "f8", ("time",))
+        pr[:] = numpy.random.default_rng(0).random(length)
+    return path
+
+
+def make_json(path, size):
+    """Write a json object of about size bytes, like gsl.json"""
+    members = max(size // 16, 1)
+    values = numpy.random.default_rng(0).random(members) * 365
+    with open(path, "w") as json_file:
+        json.dump({str(1950 + i): round(v, 1) for i, v in enumerate(values)}, json_file)
+    return path
+
+
+def make_rda(path, size, name="vector"):
+    """Write an rda file holding a numeric vector of about size bytes
+
+    Requires rpy2, see `wps_tools.R`.
+    """
+    from wps_tools.R import save_python_to_rdata
+
+    save_python_to_rdata(
+        name, numpy.random.default_rng(0).random(max(size // 8, 1)), path
+    )
+    return path
+
+
+def make_files(directory, kind, count, size):
+    """Write count files of a kind ("nc", "json" or "rda") to directory
+
+    Returns:
+        list: names of the files
+    """
+    makers = {"nc": make_netcdf, "json": make_json, "rda": make_rda}
+    names = [f"bench_{i:04d}.{kind}" for i in range(count)]
+    for name in names:
+        makers[kind](os.path.join(directory, name), size)
+    return names
@@ -0,0 +1,144 @@
+"""Timing, memory measurement, reporting and baselines"""
+# Library imports
+import gc
+import json
+import time
+import platform
+import tracemalloc
+import numpy
+
+
+def measure(name, func, repeat=5, setup=None, items=1, nbytes=0):
+    """Time repeated calls of func and measure the peak memory of one call
+
+    Parameters:
+        name (str): Name of the benchmark
+        func (callable): Function called without arguments, with the value
+            returned by setup if given
+        repeat (int): Number of timed calls
+        setup (callable): Function called before each call, not timed
+        items (int): Number of items (e.g. files) processed by a call
+        nbytes (int): Number of bytes processed by a call
+
+    Returns:
+        dict: latency percentiles and mean in seconds, throughput in items
+            and bytes per second and peak traced memory in bytes
+    """
+
+    def call():
+        if setup is None:
+            return func()
+        return func(setup())
+
+    latencies = []
+    for _ in range(repeat):
+        gc.collect()
+        if setup is None:
+            start = time.perf_counter()
+            func()
+        else:
+            state = setup()
+            start = time.perf_counter()
+            func(state)
+        latencies.append(time.perf_counter() - start)
+
+    # Tracing slows calls down, so memory is measured on a separate call
+    gc.collect()
+    tracemalloc.start()
+    try:
+        call()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    latencies = numpy.array(latencies)
+    p50, p90, p99 = numpy.percentile(latencies, [50, 90, 99])
+    mean = latencies.mean()
+    return {
+        "name": name,
+        "calls": repeat,
+        "p50": float(p50),
+        "p90": float(p90),
+        "p99": float(p99),
+        "mean": float(mean),
+        "items_per_second": items / mean if mean else None,
+        "bytes_per_second": nbytes / mean if mean and nbytes else None,
+        "peak_memory": peak,
+    }
+
+
+def _human(value, unit=""):
+    if value is None:
+        return "-"
+    for prefix in ("", "K", "M", "G"):
+        if abs(value) < 1024 or prefix == "G":
+            return f"{value:.1f}{prefix}{unit}"
+        value /= 1024
+
+
+def report(results, baseline=None, threshold=0.2):
+    """Print a table of results, compared to a baseline if given
+
+    Parameters:
+        results (list): Results of `measure`
+        baseline (dict): Baseline loaded by `load_baseline`
+        threshold (float): Relative increase of the median latency reported
+            as a regression
+
+    Returns:
+        list: names of the benchmarks that regressed
+    """
+    baseline = baseline or {}
+    regressions = []
+    header = (
+        f"{'benchmark':<40} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} "
+        f"{'items/s':>9} {'bytes/s':>9} {'peak mem':>9} {'vs base':>8}"
+    )
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        change = ""
+        base = baseline.get(result["name"])
+        if base:
+            ratio = result["p50"] / base["p50"] if base["p50"] else 1.0
+            change = f"{ratio - 1:+.0%}"
+            if ratio > 1 + threshold:
+                regressions.append(result["name"])
+                change += " !"
+        items = result["items_per_second"]
+        print(
+            f"{result['name']:<40} {result['p50'] * 1e3:>9.2f} "
+            f"{result['p90'] * 1e3:>9.2f} {result['p99'] * 1e3:>9.2f} "
+            f"{'-' if items is None else round(items, 1):>9} "
+            f"{_human(result['bytes_per_second'], 'B'):>9} "
+            f"{_human(result['peak_memory'], 'B'):>9} {change:>8}"
+        )
+    return regressions
+
+
+def save_baseline(path, results, parameters):
+    """Store results as a baseline for later runs
+
+    Parameters:
+        path (str): Path of the json file to write
+        results (list): Results of `measure`
+        parameters (dict): Parameters of the run, stored for reference
+    """
+    baseline = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "parameters": parameters,
+        "results": {result["name"]: result for result in results},
+    }
+    with open(path, "w") as baseline_file:
+        json.dump(baseline, baseline_file, indent=2)
+
+
+def load_baseline(path):
+    """Load the results of a baseline written by `save_baseline`
+
+    Returns:
+        dict: results by benchmark name
+    """
+    with open(path) as baseline_file:
+        return json.load(baseline_file)["results"]
@@ -0,0 +1,62 @@
+"""Local servers standing in for THREDDS
+
+`serve` starts a threaded HTTP server with two services over a directory:
+    /fileServer/<file>: the file, like the THREDDS HTTP file server
+    /dodsC/<file>: headers of an OPeNDAP response (Content-Description:
+        dods-dds), enough for `is_opendap_url` and `url_handler` to treat
+        the url as OPeNDAP
+"""
+# Library imports
+import os
+import threading
+from contextlib import contextmanager
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+
+class ThreddsStandInHandler(SimpleHTTPRequestHandler):
+    def do_HEAD(self):
+        if self.path.startswith("/dodsC/"):
+            self._send_dap_headers()
+        else:
+            self.path = self.path.replace("/fileServer", "", 1)
+            super().do_HEAD()
+
+    def do_GET(self):
+        if self.path.startswith("/dodsC/"):
+            self._send_dap_headers()
+        else:
+            self.path = self.path.replace("/fileServer", "", 1)
+            super().do_GET()
+
+    def _send_dap_headers(self):
+        self.send_response(200)
+        self.send_header("Content-Description", "dods-dds")
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@contextmanager
+def serve(directory):
+    """Serve directory on a free local port
+
+    Parameters:
+        directory (str): Directory of the served files
+
+    Yields:
+        str: base url of the server, e.g. http://127.0.0.1:8000
+    """
+    handler = partial(ThreddsStandInHandler, directory=os.fspath(directory))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}"
+    finally:
+        server.shutdown()
+        server.server_close()
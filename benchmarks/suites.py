@@ -0,0 +1,282 @@
+"""Benchmarks of the wps_tools helpers
+
+Each benchmark is a function taking a `Context` and returning a list of
+results from `measure`. Benchmarks are registered by name in `benchmarks`.
+"""
+# Processor imports
+from pywps import ComplexInput, FORMATS, configuration
+
+# Library imports
+import os
+import copy
+import shutil
+from tempfile import mkdtemp
+
+# Tool imports
+from benchmarks.data import make_files
+from benchmarks.harness import measure
+from wps_tools.cache import DownloadCache, OpendapProbeCache, set_opendap_probe_cache
+from wps_tools.file_handling import (
+    url_handler,
+    is_opendap_url,
+    build_meta_link,
+    output_file_metadata,
+)
+from wps_tools.io import collect_args
+from wps_tools.output_handling import auto_construct_outputs
+
+
+class Context:
+    """Files, server and parameters shared by the benchmarks
+
+    Parameters:
+        directory (str): Directory of the served files
+        base_url (str): Url of the local server
+        count (int): Number of files per benchmark
+        size (int): Approximate size in bytes of each file
+        repeat (int): Number of timed calls per benchmark
+        workers (int): Number of concurrent workers in parallel variants
+    """
+
+    def __init__(self, directory, base_url, count, size, repeat, workers):
+        self.directory = directory
+        self.base_url = base_url
+        self.count = count
+        self.size = size
+        self.repeat = repeat
+        self.workers = workers
+        self._files = {}
+
+    def files(self, kind):
+        """Names of the synthetic files of a kind, created on first use"""
+        if kind not in self._files:
+            self._files[kind] = make_files(self.directory, kind, self.count, self.size)
+        return self._files[kind]
+
+    def urls(self, kind, service="fileServer"):
+        return [f"{self.base_url}/{service}/{name}" for name in self.files(kind)]
+
+    def workdir(self):
+        """New empty directory, removed by `cleanup`"""
+        return mkdtemp(dir=self.directory, prefix="workdir_")
+
+    def measure(self, name, func, setup=None, items=None, nbytes=None):
+        return measure(
+            name,
+            func,
+            self.repeat,
+            setup,
+            items=self.count if items is None else items,
+            nbytes=self.count * self.size if nbytes is None else nbytes,
+        )
+
+
+def _fresh_probe_cache():
+    set_opendap_probe_cache(OpendapProbeCache())
+
+
+def bench_url_handler(ctx):
+    urls = ctx.urls("nc")
+    dap_urls = ctx.urls("nc", "dodsC")
+    workdir = ctx.workdir()
+    cache = DownloadCache(os.path.join(ctx.workdir(), "cache"))
+
+    def fetch_all(_=None):
+        for url in urls:
+            url_handler(workdir, url, cache=None)
+
+    def fetch_all_cached(_=None):
+        for url in urls:
+            url_handler(workdir, url, cache=cache)
+
+    def handle_opendap(_=None):
+        for url in dap_urls:
+            url_handler(workdir, url)
+
+    # Probing is measured by bench_is_opendap_url, so classify every url
+    # once and time the fetches alone
+    _fresh_probe_cache()
+    fetch_all_cached()
+    handle_opendap()
+    return [
+        ctx.measure("url_handler[fileServer]", fetch_all),
+        ctx.measure("url_handler[fileServer,cached]", fetch_all_cached),
+        ctx.measure("url_handler[dodsC]", handle_opendap, nbytes=0),
+    ]
+
+
+def bench_is_opendap_url(ctx):
+    urls = ctx.urls("nc", "dodsC") + ctx.urls("nc")
+    probe_cache = OpendapProbeCache()
+
+    def probe_all(fresh):
+        for url in urls:
+            is_opendap_url(url, fresh)
+
+    def lookup_all():
+        for url in urls:
+            is_opendap_url(url, probe_cache)
+
+    lookup_all()
+    return [
+        ctx.measure(
+            "is_opendap_url[probe]",
+            probe_all,
+            setup=OpendapProbeCache,
+            items=len(urls),
+            nbytes=0,
+        ),
+        ctx.measure("is_opendap_url[memoized]", lookup_all, items=len(urls), nbytes=0),
+    ]
+
+
+def _nc_inputs(urls):
+    template = ComplexInput(
+        "netcdf",
+        "netCDF files",
+        supported_formats=[FORMATS.NETCDF],
+        min_occurs=1,
+        max_occurs=len(urls) + 1,
+    )
+    inputs = []
+    for url in urls:
+        nc_input = copy.deepcopy(template)
+        nc_input.url = url
+        inputs.append(nc_input)
+    return {"netcdf": inputs}
+
+
+def bench_collect_args(ctx):
+    inputs = _nc_inputs(ctx.urls("nc"))
+    workdir = ctx.workdir()
+
+    def collect(_=None, max_workers=None):
+        collect_args(inputs, workdir, cache=None, max_workers=max_workers)
+
+    return [
+        ctx.measure("collect_args[serial]", collect, setup=_fresh_probe_cache),
+        ctx.measure(
+            f"collect_args[{ctx.workers} workers]",
+            lambda _: collect(max_workers=ctx.workers),
+            setup=_fresh_probe_cache,
+        ),
+    ]
+
+
+def bench_auto_construct_outputs(ctx):
+    json_urls = ctx.urls("json")
+    nc_urls = ctx.urls("nc")
+
+    def consume(outputs):
+        for output in outputs:
+            if hasattr(output, "__next__"):
+                # Lazy outputs are read as they are iterated
+                for _ in output:
+                    pass
+            elif hasattr(output, "close"):
+                output.close()
+
+    return [
+        ctx.measure(
+            "auto_construct_outputs[json]",
+            lambda: consume(auto_construct_outputs(json_urls)),
+        ),
+        ctx.measure(
+            f"auto_construct_outputs[json,{ctx.workers} workers]",
+            lambda: consume(auto_construct_outputs(json_urls, ctx.workers)),
+        ),
+        ctx.measure(
+            "auto_construct_outputs[json,lazy]",
+            lambda: consume(auto_construct_outputs(json_urls, lazy=True)),
+        ),
+        ctx.measure(
+            f"auto_construct_outputs[nc,{ctx.workers} workers]",
+            lambda: consume(auto_construct_outputs(nc_urls, ctx.workers)),
+        ),
+    ]
+
+
+def bench_build_meta_link(ctx):
+    outfiles = ctx.files("nc")
+    # MetaFile copies the files to the pywps output path
+    if not configuration.CONFIG:
+        configuration.load_configuration()
+    outputpath = configuration.CONFIG.get("server", "outputpath", raw=True)
+    configuration.CONFIG.set("server", "outputpath", ctx.workdir())
+    try:
+        return _bench_build_meta_link(ctx, outfiles)
+    finally:
+        configuration.CONFIG.set("server", "outputpath", outputpath)
+
+
+def _bench_build_meta_link(ctx, outfiles):
+    metadata = {
+        name: output_file_metadata(os.path.join(ctx.directory, name))
+        for name in outfiles
+    }
+
+    def build(checksums=None, metadata=None, max_workers=None):
+        build_meta_link(
+            "pr",
+            "Benchmark",
+            outfiles,
+            outdir=ctx.directory,
+            checksums=checksums,
+            metadata=metadata,
+            max_workers=max_workers,
+        )
+
+    return [
+        ctx.measure("build_meta_link", build),
+        ctx.measure(
+            "build_meta_link[checksums,1 worker]",
+            lambda: build(checksums=True, max_workers=1),
+        ),
+        ctx.measure(
+            f"build_meta_link[checksums,{ctx.workers} workers]",
+            lambda: build(checksums=True, max_workers=ctx.workers),
+        ),
+        ctx.measure("build_meta_link[precomputed]", lambda: build(metadata=metadata)),
+    ]
+
+
+def bench_r(ctx):
+    try:
+        from wps_tools.R import rda_to_vector, load_rdata_file, REnvironmentPool
+    except ImportError:
+        print("Skipping R benchmarks: rpy2 is not installed")
+        return []
+
+    urls = ctx.urls("rda")
+    paths = [os.path.join(ctx.directory, name) for name in ctx.files("rda")]
+
+    def load_urls(_=None):
+        for url in urls:
+            rda_to_vector(url, "vector", as_numpy=True)
+
+    def load_paths(pool):
+        for path in paths:
+            load_rdata_file(path, ["vector"], pool=pool)
+
+    return [
+        ctx.measure("rda_to_vector[fileServer,numpy]", load_urls),
+        ctx.measure(
+            "load_rdata_file[uncached]",
+            load_paths,
+            setup=REnvironmentPool,
+        ),
+    ]
+
+
+benchmarks = {
+    "url_handler": bench_url_handler,
+    "is_opendap_url": bench_is_opendap_url,
+    "collect_args": bench_collect_args,
+    "auto_construct_outputs": bench_auto_construct_outputs,
+    "build_meta_link": bench_build_meta_link,
+    "R": bench_r,
+}
+
+
+def cleanup(ctx):
+    shutil.rmtree(ctx.directory, ignore_errors=True)
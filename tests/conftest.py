@@ -1,7 +1,10 @@
 import pytest
-import requests
+import threading
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
 from tempfile import NamedTemporaryFile
 from pywps import Process, LiteralInput, ComplexInput, LiteralOutput, FORMATS, Format
+from wps_tools import output_handling
 from wps_tools.io import collect_args
 from wps_tools.file_handling import build_meta_link
 from pkg_resources import resource_filename
@@ -155,6 +158,19 @@ class MockResponse:
     def meta4(self):
         return self.content
 
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start : start + chunk_size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
 
 def mock_metalink_respose(*args, **kwargs):
     outfiles = ["gsl.json", "tiny_daily_pr.nc"]
@@ -171,9 +187,30 @@ def mock_metalink_respose(*args, **kwargs):
 
 @pytest.fixture
 def mock_metalink(monkeypatch):
-    monkeypatch.setattr(requests, "get", mock_metalink_respose)
+    monkeypatch.setattr(output_handling, "open_url", mock_metalink_respose)
 
 
 @pytest.fixture
 def csv_data():
     return open(resource_filename("tests", "data/tiny_rules.csv")).read()
+
+
+class QuietHTTPRequestHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    """Serve tests/data over http on a free local port, yielding the base url"""
+    handler = partial(
+        QuietHTTPRequestHandler, directory=resource_filename("tests", "data")
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield f"http://127.0.0.1:{server.server_port}"
+
+    server.shutdown()
+    server.server_close()
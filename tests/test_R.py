@@ -1,4 +1,5 @@
 import pytest
+import numpy
 from pkg_resources import resource_filename
 from tempfile import NamedTemporaryFile
 from rpy2 import robjects
@@ -8,6 +9,16 @@ from wps_tools.R import (
     save_python_to_rdata,
     r_valid_name,
     get_robjects,
+    load_rdata,
+    construct_r_out,
+    REnvironmentPool,
+    warm_packages,
+    package_cache_info,
+    rda_to_vector,
+    r_to_numpy,
+    numpy_to_r,
+    compare_r_objects,
+    test_rda_output as rda_output_check,
 )
 from wps_tools.testing import local_path
 from pywps.app.exceptions import ProcessError
@@ -22,6 +33,25 @@ def test_get_package(package):
     assert pkg.__dict__["__rname__"] == package
 
 
+@pytest.mark.parametrize(("package"), [("utils")])
+def test_get_package_cached(package):
+    first = get_package(package)
+    hits = package_cache_info()["hits"]
+
+    assert get_package(package) is first
+    assert package_cache_info()["hits"] == hits + 1
+    assert package in package_cache_info()["import_seconds"]
+
+
+@pytest.mark.parametrize(("packages"), [["base", "utils"]])
+def test_warm_packages(monkeypatch, packages):
+    monkeypatch.setenv("WPS_TOOLS_R_PACKAGES", ",".join(packages))
+    timings = warm_packages()
+
+    assert list(timings) == packages
+    assert all(seconds >= 0 for seconds in timings.values())
+
+
 @pytest.mark.parametrize("package", ["invalid_pkg"])
 def test_get_package_err(package):
     with pytest.raises(ProcessError) as e:
@@ -101,3 +131,200 @@ def test_get_robjects(url):
     assert len(objects) > 0
     for ob in objects:
         assert isinstance(ob, str)
+
+
+@pytest.mark.parametrize(
+    ("url", "r_object_names", "expected"),
+    [
+        (local_path("expected_gsl.rda"), None, ["expected_gsl_vector"]),
+        (
+            local_path("expected_gsl.rda"),
+            ["expected_gsl_vector"],
+            ["expected_gsl_vector"],
+        ),
+    ],
+)
+def test_load_rdata(url, r_object_names, expected):
+    objects = load_rdata(url, r_object_names)
+
+    assert list(objects) == expected
+    for obj in objects.values():
+        assert "robjects" in str(type(obj))
+    assert "expected_gsl_vector" not in list(robjects.globalenv.keys())
+
+
+@pytest.mark.parametrize(
+    ("url", "r_object_name"),
+    [(local_path("expected_days_data.rda"), "autumn_days")],
+)
+def test_load_rdata_err(url, r_object_name):
+    with pytest.raises(ProcessError) as e:
+        load_rdata(url, [r_object_name])
+    assert (
+        str(e.value)
+        == "RRuntimeError: The variable name passed is not an object found in the given rda file"
+    )
+
+
+@pytest.mark.parametrize(
+    ("outputs"),
+    [[local_path("expected_gsl.rda"), local_path("expected_days_data.rda")]],
+)
+def test_construct_r_out(outputs):
+    r_out = construct_r_out(outputs)
+
+    assert len(r_out) == len(outputs)
+    for objects, url in zip(r_out, outputs):
+        assert len(objects) == len(get_robjects(url))
+
+
+@pytest.mark.parametrize(
+    ("r_file", "r_object_name"),
+    [(resource_filename(__name__, "data/expected_gsl.rda"), "expected_gsl_vector")],
+)
+def test_environment_pool(r_file, r_object_name):
+    pool = REnvironmentPool(max_loaded=1)
+    first_env, names = pool.load_file(r_file)
+    second_env, _ = pool.load_file(r_file)
+
+    assert r_object_name in names
+    assert first_env.rid == second_env.rid
+    assert (pool.hits, pool.misses) == (1, 1)
+    assert r_object_name not in list(robjects.globalenv.keys())
+
+    pool.load_file(resource_filename(__name__, "data/expected_days_data.rda"))
+    pool.load_file(r_file)
+    assert pool.misses == 3
+
+
+def test_environment_pool_named():
+    pool = REnvironmentPool()
+    first = pool.environment("first")
+    first["x"] = 1
+
+    assert pool.environment("first").rid == first.rid
+    assert "x" not in list(pool.environment("second").keys())
+
+    pool.release("first")
+    assert "x" not in list(pool.environment("first").keys())
+
+
+@pytest.mark.parametrize(
+    ("url", "vector_name"),
+    [
+        (local_path("expected_gsl.rda"), "expected_gsl_vector"),
+        (local_path("matrix.rda"), None),
+    ],
+)
+def test_rda_to_vector_as_numpy(url, vector_name):
+    vector_name = vector_name or get_robjects(url)[0]
+    vector = rda_to_vector(url, vector_name)
+    array = rda_to_vector(url, vector_name, as_numpy=True)
+
+    assert isinstance(array, numpy.ndarray)
+    assert array.size == len(vector)
+    assert [str(value) for value in array.ravel(order="F")][:10] == [
+        str(value) for value in list(vector)[:10]
+    ]
+
+
+@pytest.mark.parametrize(
+    ("value"),
+    [
+        numpy.arange(6, dtype=float),
+        numpy.arange(6, dtype=numpy.int32).reshape(2, 3),
+        numpy.array([True, False]),
+        numpy.array(["a", "b"]),
+    ],
+)
+def test_numpy_round_trip(value):
+    array = r_to_numpy(numpy_to_r(value))
+
+    assert array.shape == value.shape
+    assert (array == value).all()
+
+
+@pytest.mark.parametrize(
+    ("expression", "dtype", "expected"),
+    [
+        ("c(1L, NA, 3L)", numpy.int32, [1, None, 3]),
+        ("c(TRUE, NA, FALSE)", bool, [True, None, False]),
+        ('factor(c("a", NA, "b"))', str, ["a", None, "b"]),
+        ("factor(c(NA, NA))", str, [None, None]),
+    ],
+)
+def test_r_to_numpy_na(expression, dtype, expected):
+    array = r_to_numpy(robjects.r(expression))
+
+    assert isinstance(array, numpy.ma.MaskedArray)
+    assert numpy.issubdtype(array.dtype, dtype)
+    assert array.tolist() == expected
+
+
+@pytest.mark.parametrize(
+    ("r_name", "py_var"),
+    [("matrix_ex", numpy.arange(12, dtype=float).reshape(3, 4))],
+)
+def test_save_python_to_rdata_numpy(r_name, py_var):
+    with NamedTemporaryFile(
+        suffix=".rda", prefix="tmp_copy", dir="/tmp", delete=True
+    ) as r_file:
+        save_python_to_rdata(r_name, py_var, r_file.name)
+        test_var = load_rdata_to_python(r_file.name, r_name, as_numpy=True)
+
+    assert (test_var == py_var).all()
+
+
+@pytest.mark.parametrize(
+    ("url", "vector_name", "expected_file", "expected_vector_name"),
+    [
+        (
+            local_path("expected_gsl.rda"),
+            "expected_gsl_vector",
+            "expected_gsl.rda",
+            "expected_gsl_vector",
+        ),
+        (local_path("matrix.rda"), "mdat", "matrix.rda", "mdat"),
+    ],
+)
+@pytest.mark.parametrize(("vectorized"), [True, False])
+def test_test_rda_output(
+    url, vector_name, expected_file, expected_vector_name, vectorized
+):
+    rda_output_check(
+        url, vector_name, expected_file, expected_vector_name, vectorized=vectorized
+    )
+
+
+@pytest.mark.parametrize(
+    ("actual", "expected", "rtol"),
+    [
+        (numpy.array([1.0, numpy.nan]), numpy.array([1.0, numpy.nan]), 0),
+        (numpy.array([1.0, 2.0]), numpy.array([1.0, 2.000001]), 1e-5),
+        ({"a": [numpy.array(["x"])]}, {"a": [numpy.array(["x"])]}, 0),
+    ],
+)
+def test_compare_r_objects(actual, expected, rtol):
+    compare_r_objects(actual, expected, rtol=rtol)
+
+
+@pytest.mark.parametrize(
+    ("actual", "expected", "message"),
+    [
+        (
+            numpy.array([[1.0, 2.0], [3.0, 4.0]]),
+            numpy.array([[1.0, 2.0], [3.0, 5.0]]),
+            "1 of 4 values differ, first at [(1, 1)]: [4.0] != [5.0]",
+        ),
+        (
+            {"a": numpy.array([1, 2])},
+            {"a": numpy.array([1, 3])},
+            "1 of 2 values differ at $a, first at [(1,)]: [2] != [3]",
+        ),
+        ({"a": 1}, {"b": 1}, "Names differ: ['a'] != ['b']"),
+    ],
+)
+def test_compare_r_objects_err(actual, expected, message):
+    with pytest.raises(AssertionError) as e:
+        compare_r_objects(actual, expected)
+    assert str(e.value) == message
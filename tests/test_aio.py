@@ -0,0 +1,77 @@
+import pytest
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from netCDF4 import Dataset
+from requests.exceptions import HTTPError
+
+from wps_tools import aio
+from wps_tools.testing import local_path
+
+
+@pytest.mark.parametrize(("filenames"), [["gsl.json"] * 5])
+def test_gather_json_to_dict(http_server, filenames):
+    async def gather():
+        return await asyncio.gather(
+            *(aio.json_to_dict(f"{http_server}/{filename}") for filename in filenames)
+        )
+
+    dicts = asyncio.run(gather())
+    assert len(dicts) == len(filenames)
+    assert all(isinstance(value, dict) and value == dicts[0] for value in dicts)
+
+
+@pytest.mark.parametrize(
+    ("filenames", "expected_types"),
+    [(["gsl.json", "tiny_daily_pr.nc", "test string"], [dict, Dataset, str])],
+)
+@pytest.mark.parametrize(("max_concurrency"), [None, 1])
+def test_auto_construct_outputs(
+    http_server, filenames, expected_types, max_concurrency
+):
+    outputs = [
+        f"{http_server}/{filename}" if "." in filename else filename
+        for filename in filenames
+    ]
+    constructed = asyncio.run(aio.auto_construct_outputs(outputs, max_concurrency))
+    assert [type(output) for output in constructed] == expected_types
+
+
+def test_auto_construct_outputs_lazy(http_server):
+    outputs = [f"{http_server}/gsl.json", "test string"]
+    constructed = asyncio.run(aio.auto_construct_outputs(outputs, lazy=True))
+
+    assert not isinstance(constructed[0], dict)
+    assert dict(constructed[0]) == asyncio.run(aio.json_to_dict(outputs[0]))
+    assert constructed[1] == "test string"
+
+
+def test_auto_construct_outputs_err(http_server):
+    outputs = [local_path("gsl.json"), f"{http_server}/missing.json"]
+    with pytest.raises(HTTPError):
+        asyncio.run(aio.auto_construct_outputs(outputs))
+
+
+def test_cancel():
+    executor = ThreadPoolExecutor(max_workers=1)
+    release = threading.Event()
+    calls = []
+
+    def blocking(name):
+        calls.append(name)
+        release.wait(5)
+        return name
+
+    async def cancel_queued():
+        running = asyncio.ensure_future(aio.run(blocking, "a", executor=executor))
+        queued = asyncio.ensure_future(aio.run(blocking, "b", executor=executor))
+        await asyncio.sleep(0.1)
+        queued.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await queued
+        release.set()
+        return await running
+
+    assert asyncio.run(cancel_queued()) == "a"
+    executor.shutdown(wait=True)
+    assert calls == ["a"]
@@ -0,0 +1,186 @@
+import pytest
+import os
+import hashlib
+from pkg_resources import resource_filename
+from tempfile import TemporaryDirectory
+from wps_tools.cache import DownloadCache, OpendapProbeCache
+from wps_tools.download import ChecksumMismatchError
+
+
+@pytest.fixture
+def cache_dir():
+    with TemporaryDirectory() as tmpdir:
+        yield tmpdir
+
+
+@pytest.mark.parametrize(("filename"), ["gsl.json", "tiny_rules.csv"])
+@pytest.mark.parametrize(("link"), ["hardlink", "symlink", "copy"])
+def test_download_cache_fetch(http_server, cache_dir, filename, link):
+    cache = DownloadCache(os.path.join(cache_dir, "cache"), link=link)
+    url = f"{http_server}/{filename}"
+    with TemporaryDirectory() as workdir:
+        first = cache.fetch(url, os.path.join(workdir, "first"))
+        second = cache.fetch(url, os.path.join(workdir, "second"))
+        assert open(first, "rb").read() == open(second, "rb").read()
+        if link == "symlink":
+            assert os.path.islink(second)
+
+    stats = cache.stats.as_dict()
+    assert stats["misses"] == 1
+    assert stats["hits"] == 1
+    assert stats["revalidations"] == 1
+    assert stats["bytes_saved"] == cache.size
+
+
+def test_download_cache_dedup(http_server, cache_dir):
+    cache = DownloadCache(cache_dir)
+    first = cache.get(f"{http_server}/gsl.json")
+    second = cache.get(f"{http_server}/./gsl.json")
+
+    assert first == second
+    assert cache.stats.misses == 2
+
+
+def test_download_cache_evict(http_server, cache_dir):
+    cache = DownloadCache(cache_dir, max_bytes=1)
+    first = cache.get(f"{http_server}/gsl.json")
+    second = cache.get(f"{http_server}/tiny_rules.csv")
+
+    assert not os.path.exists(first)
+    assert os.path.exists(second)
+    assert cache.stats.evictions == 1
+
+    cache.clear()
+    assert cache.size == 0
+    assert cache._url_locks == {}
+
+
+def test_download_cache_shared_dir(http_server, cache_dir):
+    cache = DownloadCache(cache_dir)
+    cache.get(f"{http_server}/gsl.json")
+    entries = cache._entries()
+    for key in entries:
+        os.remove(cache._entry_path(key))
+
+    # Entries read just before another process evicted them
+    cache._entries = lambda: entries
+    cache.evict(max_bytes=0)
+    assert cache.stats.evictions == 0
+    assert cache.size == 0
+
+
+def test_download_cache_evict_pinned(http_server, cache_dir):
+    cache = DownloadCache(cache_dir, max_bytes=1)
+    with cache._checkout(f"{http_server}/gsl.json") as blob:
+        cache.clear()
+        assert os.path.exists(blob)
+    cache.clear()
+    assert cache.size == 0
+
+
+@pytest.mark.parametrize(("link"), ["hardlink", "symlink"])
+def test_download_cache_place_missing(cache_dir, link):
+    cache = DownloadCache(cache_dir, link=link)
+    dest = os.path.join(cache_dir, "dest")
+    with pytest.raises(FileNotFoundError):
+        cache._place(os.path.join(cache_dir, "objects", "missing"), dest)
+    assert not os.path.lexists(dest)
+
+
+@pytest.mark.parametrize(("filename"), ["gsl.json"])
+def test_download_cache_digest_key(http_server, cache_dir, filename):
+    content = open(resource_filename("tests", f"data/{filename}"), "rb").read()
+    sha256 = hashlib.sha256(content).hexdigest()
+    cache = DownloadCache(cache_dir)
+
+    first = cache.get(f"{http_server}/{filename}", sha256)
+    # Served by digest without a request, so the url need not exist
+    second = cache.get(f"{http_server}/copy_of_{filename}", sha256)
+    assert first == second
+    assert cache.stats.misses == 1
+    assert cache.stats.hits == 1
+
+    with pytest.raises(ChecksumMismatchError):
+        cache.get(f"{http_server}/tiny_rules.csv", "0" * 64)
+
+
+@pytest.mark.parametrize(("filename"), ["tiny_rules.csv"])
+def test_download_cache_mismatch_not_kept(http_server, cache_dir, filename):
+    cache = DownloadCache(cache_dir)
+    with pytest.raises(ChecksumMismatchError):
+        cache.get(f"{http_server}/{filename}", "0" * 64)
+    assert cache.size == 0
+
+    cache.get(f"{http_server}/{filename}")
+    assert cache.stats.misses == 2
+    assert cache.stats.hits == 0
+
+
+@pytest.mark.parametrize(("link"), ["softlink"])
+def test_download_cache_err(cache_dir, link):
+    with pytest.raises(ValueError):
+        DownloadCache(cache_dir, link=link)
+
+
+thredds = "https://marble-dev01.pcic.uvic.ca/twitcher/ows/proxy/thredds"
+
+
+@pytest.mark.parametrize(
+    ("probed", "other", "is_opendap"),
+    [
+        (f"{thredds}/dodsC/datasets/a.nc", f"{thredds}/dodsC/datasets/b.nc", True),
+        (
+            f"{thredds}/fileServer/datasets/a.nc",
+            f"{thredds}/fileServer/datasets/b.nc",
+            False,
+        ),
+    ],
+)
+def test_opendap_probe_cache_rules(probed, other, is_opendap):
+    probe_cache = OpendapProbeCache()
+    assert probe_cache.lookup(probed) is None
+
+    probe_cache.store(probed, is_opendap)
+    assert probe_cache.lookup(probed) is is_opendap
+    assert probe_cache.lookup(other) is is_opendap
+    assert probe_cache.stats.as_dict() == {
+        "hits": 1,
+        "rule_hits": 1,
+        "misses": 1,
+        "rules_learned": 1,
+    }
+
+
+@pytest.mark.parametrize(
+    ("url"),
+    [f"{thredds}/dodsC/datasets/a.nc", "http://example.com/data/a.nc"],
+)
+def test_opendap_probe_cache_no_rule(url):
+    probe_cache = OpendapProbeCache()
+    probe_cache.store(url, False)
+
+    assert probe_cache.lookup(url) is False
+    assert probe_cache.lookup(url.replace("a.nc", "b.nc")) is None
+
+
+def test_opendap_probe_cache_ttl():
+    probe_cache = OpendapProbeCache(ttl=0)
+    probe_cache.store("http://example.com/data/a.nc", True)
+
+    assert probe_cache.lookup("http://example.com/data/a.nc") is None
+
+
+@pytest.mark.parametrize(
+    ("locations", "url", "expected"),
+    [
+        (["example.com"], "http://example.com/data/a.nc", True),
+        (["example.com/thredds/dodsC"], "http://example.com/thredds/dodsC/a.nc", True),
+        (["example.com/thredds/dodsC"], "http://example.com/thredds/a.nc", None),
+        (["example.com/thredds/dodsC"], "http://other.com/thredds/dodsC/a.nc", None),
+    ],
+)
+def test_opendap_probe_cache_seed(locations, url, expected):
+    probe_cache = OpendapProbeCache()
+    probe_cache.seed(locations)
+
+    assert probe_cache.lookup(url) is expected
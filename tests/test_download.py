@@ -0,0 +1,95 @@
+import pytest
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pkg_resources import resource_filename
+from tempfile import NamedTemporaryFile
+from wps_tools.download import (
+    download,
+    IncompleteDownloadError,
+    ChecksumMismatchError,
+)
+from wps_tools.testing import local_path
+
+content = bytes(range(256)) * 1024
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """Drops the connection halfway through every full-content response"""
+
+    def do_GET(self):
+        offset = 0
+        range_header = self.headers.get("Range")
+        if range_header and self.server.support_ranges:
+            offset = int(range_header.split("=")[1].rstrip("-"))
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", f"bytes {offset}-{len(content) - 1}/{len(content)}"
+            )
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(content) - offset))
+        self.end_headers()
+
+        if offset:
+            self.wfile.write(content[offset:])
+        else:
+            self.wfile.write(content[: len(content) // 2])
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(params=[True, False], ids=["ranges", "no_ranges"])
+def flaky_server(request):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+    server.support_ranges = request.param
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize(("filename"), ["gsl.json", "tiny_daily_pr.nc"])
+@pytest.mark.parametrize(("chunk_size"), [None, 1000])
+def test_download(http_server, filename, chunk_size):
+    expected = open(resource_filename("tests", f"data/{filename}"), "rb").read()
+    for url in [f"{http_server}/{filename}", local_path(filename)]:
+        with NamedTemporaryFile(suffix=filename, dir="/tmp") as tmp_file:
+            result = download(url, tmp_file, chunk_size=chunk_size, digest="sha256")
+            tmp_file.seek(0)
+            assert tmp_file.read() == expected
+
+        assert result.size == len(expected)
+        assert result.digest == hashlib.sha256(expected).hexdigest()
+
+
+def test_download_resume(flaky_server):
+    url = f"http://127.0.0.1:{flaky_server.server_port}/data.bin"
+    with NamedTemporaryFile(dir="/tmp") as tmp_file:
+        if flaky_server.support_ranges:
+            result = download(url, tmp_file, chunk_size=4096, digest="sha256")
+            tmp_file.seek(0)
+            assert tmp_file.read() == content
+            assert result.digest == hashlib.sha256(content).hexdigest()
+        else:
+            with pytest.raises(IncompleteDownloadError):
+                download(url, tmp_file, chunk_size=4096, max_resumes=2)
+
+
+@pytest.mark.parametrize(("filename"), ["gsl.json"])
+def test_download_expected_digest(http_server, filename):
+    expected = open(resource_filename("tests", f"data/{filename}"), "rb").read()
+    sha256 = hashlib.sha256(expected).hexdigest()
+    for url in [f"{http_server}/{filename}", local_path(filename)]:
+        with NamedTemporaryFile(dir="/tmp") as tmp_file:
+            result = download(url, tmp_file, expected_digest=sha256.upper())
+            assert result.digest == sha256
+
+        with NamedTemporaryFile(dir="/tmp") as tmp_file:
+            with pytest.raises(ChecksumMismatchError):
+                download(url, tmp_file, expected_digest="0" * 64)
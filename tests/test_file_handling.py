@@ -1,22 +1,34 @@
 import pytest
+import numpy
+from io import FileIO, StringIO
+from pywps.app.exceptions import ProcessError
+import re
+from pywps import FORMATS
 from pkg_resources import resource_filename
 from collections import namedtuple
 from wps_tools.file_handling import (
     is_opendap_url,
     get_filepaths,
+    validate_nc_inputs,
+    sniff_netcdf,
     collect_output_files,
     build_meta_link,
+    OutputIndex,
+    output_file_metadata,
     copy_http_content,
     url_handler,
     csv_handler,
+    iter_csv_batches,
 )
+from wps_tools.cache import OpendapProbeCache
+from wps_tools.download import file_digest
 from wps_tools.testing import (
     local_path,
     url_path,
 )
 from netCDF4 import Dataset
-from tempfile import NamedTemporaryFile
-from os import path, remove
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from os import path, remove, makedirs
 
 NCInput = namedtuple("NCInput", ["url", "file"])
 NCInput.__new__.__defaults__ = ("", "")
@@ -41,6 +53,14 @@ def test_is_opendap_url(url):
         )  # Ensure function recognizes this is not an opendap file
 
 
+def test_is_opendap_url_not_memoized(http_server):
+    probe_cache = OpendapProbeCache()
+    url = f"{http_server}/gsl.json"
+
+    assert not is_opendap_url(url, probe_cache)
+    assert probe_cache.lookup(url) is None
+
+
 @pytest.mark.parametrize(
     ("nc_input"),
     [[NCInput(file=local_path(nc_file))]],
@@ -52,6 +72,36 @@ def test_get_filepaths_local(nc_input):
         assert nc_file in path
 
 
+@pytest.mark.parametrize(
+    ("filename", "expected"),
+    [("tiny_daily_pr.nc", True), ("gsl.json", False), ("missing.nc", None)],
+)
+def test_sniff_netcdf(filename, expected):
+    assert sniff_netcdf(local_path(filename)) is expected
+
+
+def test_validate_nc_inputs(http_server):
+    nc_input = [
+        NCInput(file=local_path("tiny_daily_pr.nc")),
+        NCInput(
+            url=f"{http_server}/tiny_daily_pr.nc",
+            file=resource_filename(__name__, "data/tiny_daily_pr.nc"),
+        ),
+        NCInput(file=local_path("gsl.json")),
+    ]
+    checks = validate_nc_inputs(nc_input, max_workers=2)
+    assert [check.kind for check in checks] == [
+        "local-netcdf",
+        "local-netcdf",
+        "rejected",
+    ]
+    assert checks[0].path == nc_input[0].file
+
+    with pytest.raises(ProcessError):
+        get_filepaths(nc_input)
+    assert len(get_filepaths(nc_input[:2])) == 2
+
+
 @pytest.mark.online
 @pytest.mark.parametrize(
     ("nc_input"),
@@ -85,6 +135,80 @@ def test_collect_output_files(varname, outdir):
     )
 
 
+@pytest.fixture
+def chunked_outdir():
+    names = [
+        "pr_day_20000101-20091231.nc",
+        "pr_day_19900101-19991231.nc",
+        "prsn_day_19900101-19991231.nc",
+        "sub/pr_day_1980-1989.nc",
+        "pr_notes.txt",
+    ]
+    with TemporaryDirectory() as outdir:
+        makedirs(path.join(outdir, "sub"))
+        for name in names:
+            open(path.join(outdir, name), "w").close()
+        yield outdir
+
+
+@pytest.mark.parametrize(
+    ("varname", "kwargs", "expected"),
+    [
+        (
+            "pr",
+            {"match": "token", "sort": "time"},
+            [
+                "pr_day_19900101-19991231.nc",
+                "pr_day_20000101-20091231.nc",
+                "pr_notes.txt",
+            ],
+        ),
+        (
+            "pr_*.nc",
+            {"match": "glob", "recursive": True, "sort": "time"},
+            [
+                path.join("sub", "pr_day_1980-1989.nc"),
+                "pr_day_19900101-19991231.nc",
+                "pr_day_20000101-20091231.nc",
+            ],
+        ),
+        (
+            re.compile(r"^prsn_.*\.nc$"),
+            {},
+            ["prsn_day_19900101-19991231.nc"],
+        ),
+        ("pr", {"sort": "name"}, 4),
+    ],
+)
+def test_collect_output_files_match(chunked_outdir, varname, kwargs, expected):
+    outfiles = collect_output_files(varname, chunked_outdir, **kwargs)
+    if isinstance(expected, int):
+        assert len(outfiles) == expected
+        assert outfiles == sorted(outfiles)
+    else:
+        assert outfiles == expected
+
+
+def test_collect_output_files_index(chunked_outdir):
+    index = OutputIndex(chunked_outdir)
+    index.register(path.join(chunked_outdir, "pr_day_20000101-20091231.nc"))
+    index.register("sub/pr_day_1980-1989.nc")
+    index.register("prsn_day_19900101-19991231.nc")
+    index.unregister("prsn_day_19900101-19991231.nc")
+
+    assert len(index) == 2
+    assert collect_output_files("pr", chunked_outdir, index=index) == [
+        "pr_day_20000101-20091231.nc"
+    ]
+    assert len(collect_output_files("pr", index=index, recursive=True)) == 2
+
+
+@pytest.mark.parametrize(("kwargs"), [{"match": "exact"}, {"sort": "size"}])
+def test_collect_output_files_err(chunked_outdir, kwargs):
+    with pytest.raises(ValueError):
+        collect_output_files("pr", chunked_outdir, **kwargs)
+
+
 @pytest.mark.parametrize(
     ("outfiles", "expected"),
     [
@@ -102,6 +226,45 @@ def test_build_meta_link(outfiles, expected):
         outdir=resource_filename(__name__, "data"),
     )
     assert all([elem in xml for elem in expected])
+    assert "<hash" not in xml
+
+
+@pytest.mark.parametrize(("outfiles"), [["tiny_rules.csv", "gsl.json"]])
+@pytest.mark.parametrize(("max_workers"), [None, 1])
+def test_build_meta_link_checksums(outfiles, max_workers):
+    outdir = resource_filename(__name__, "data")
+    xml = build_meta_link(
+        varname="rules",
+        desc="Rules",
+        outfiles=outfiles,
+        format_name="CSV",
+        fmt=FORMATS.CSV,
+        outdir=outdir,
+        checksums=True,
+        max_workers=max_workers,
+    )
+    for outfile in outfiles:
+        metadata = output_file_metadata(path.join(outdir, outfile))
+        assert metadata["sha256"] == file_digest(path.join(outdir, outfile))
+        assert f'<hash type="sha-256">{metadata["sha256"]}</hash>' in xml
+        assert f'<size>{metadata["size"]}</size>' in xml
+
+
+@pytest.mark.parametrize(("outfile"), ["tiny_rules.csv"])
+def test_build_meta_link_metadata(outfile):
+    # Precomputed metadata is emitted as given, without reading the file
+    metadata = {outfile: {"size": 12345, "sha256": "ab" * 32}}
+    xml = build_meta_link(
+        varname="rules",
+        desc="Rules",
+        outfiles=[outfile],
+        format_name="CSV",
+        fmt=FORMATS.CSV,
+        outdir=resource_filename(__name__, "data"),
+        metadata=metadata,
+    )
+    assert f'<hash type="sha-256">{"ab" * 32}</hash>' in xml
+    assert "<size>12345</size>" in xml
 
 
 @pytest.mark.online
@@ -148,3 +311,65 @@ def test_url_handler(url_type, url):
 def test_csv_handler(file_, expected_content):
     csv_content = csv_handler(file_)
     assert all([rule in csv_content for rule in expected_content])
+
+
+@pytest.mark.parametrize(
+    ("file_", "expected_rows"),
+    [
+        (
+            resource_filename("tests", "data/tiny_rules.csv"),
+            [{"id": "snow", "condition": "(temp_djf_iamean_s0p_hist <= -6)"}],
+        )
+    ],
+)
+def test_iter_csv_batches_sources(file_, expected_rows):
+    with open(file_, "rb") as binary, open(file_, "r") as text:
+        for source in [file_, FileIO(file_), binary, text]:
+            assert list(iter_csv_batches(source)) == [expected_rows]
+        assert not binary.closed and not text.closed
+
+
+csv_content = "station,days,length\na,1,0.5\nb,2,\nc,3,1.5\n\nd,4,2.5\n"
+
+
+@pytest.mark.parametrize(("batch_size"), [1, 3, 100])
+def test_iter_csv_batches_types(batch_size):
+    batches = list(
+        iter_csv_batches(StringIO(csv_content), batch_size, infer_types=True)
+    )
+    assert [len(batch) for batch in batches] == [
+        min(batch_size, 4 - start) for start in range(0, 4, batch_size)
+    ]
+    rows = [row for batch in batches for row in batch]
+    assert rows[1] == {"station": "b", "days": 2, "length": None}
+    assert rows[3] == {"station": "d", "days": 4, "length": 2.5}
+
+
+def test_iter_csv_batches_columns():
+    (batch,) = iter_csv_batches(StringIO(csv_content), infer_types=True, columns=True)
+    assert batch["station"].tolist() == ["a", "b", "c", "d"]
+    assert batch["days"].dtype == numpy.int64
+    assert batch["length"].dtype == numpy.float64
+    assert numpy.isnan(batch["length"][1])
+
+    (batch,) = iter_csv_batches(StringIO(csv_content), header=False, columns=True)
+    assert batch[0][0] == "station"
+
+
+def test_iter_csv_batches_err():
+    batches = iter_csv_batches(StringIO("days\n1\n2\nthree\n"), 2, infer_types=True)
+    assert next(batches) == [{"days": 1}, {"days": 2}]
+    with pytest.raises(ValueError):
+        next(batches)
+
+
+@pytest.mark.parametrize(("content"), ["a,b\n1,2,3\n", "a,b\n1,2\n3,4\n5,6,7\n"])
+def test_iter_csv_batches_extra_fields(content):
+    with pytest.raises(ValueError):
+        list(iter_csv_batches(StringIO(content), 2))
+
+
+def test_iter_csv_batches_zero_padded():
+    content = "station,days\n0012,1\n0345,2\n"
+    (rows,) = iter_csv_batches(StringIO(content), infer_types=True)
+    assert rows == [{"station": "0012", "days": 1}, {"station": "0345", "days": 2}]
@@ -4,6 +4,7 @@ from wps_tools.testing import (
     url_path,
 )
 from wps_tools.testing import run_wps_process
+from wps_tools.io import _local_filenames
 
 
 def run_args_collection(wps_test_process_multi_input, file, csv, argc):
@@ -31,6 +32,24 @@ def test_collect_args_local(wps_test_process_multi_input, file, csv_data, argc):
     run_args_collection(wps_test_process_multi_input, file, f"{csv_data}", argc)
 
 
+@pytest.mark.parametrize(
+    ("urls", "expected"),
+    [
+        (
+            [
+                "http://a.org/tasmax.nc",
+                "http://b.org/tasmax.nc",
+                "http://c.org/tasmax_1.nc",
+                "http://d.org/pr.nc",
+            ],
+            ["tasmax.nc", "tasmax_1.nc", "tasmax_1_1.nc", "pr.nc"],
+        )
+    ],
+)
+def test_local_filenames(urls, expected):
+    assert list(_local_filenames(urls).values()) == expected
+
+
 @pytest.mark.online
 @pytest.mark.parametrize(
     ("file", "csv", "argc"),
@@ -1,8 +1,19 @@
 import pytest
 import logging
+import json
 import os
+import sys
 from tempfile import TemporaryDirectory
-from wps_tools.logging import log_handler
+from wps_tools.logging import (
+    log_handler,
+    get_log_sink,
+    close_log_sinks,
+    closing_log_sinks,
+    StatusThrottle,
+    get_status_throttle,
+    log_span,
+    peak_rss,
+)
 from .common import TestResponse
 
 logger = logging.getLogger()
@@ -41,3 +52,127 @@ def test_log_handler(
         assert message in caplog.text
     except AssertionError:
         pass
+
+
+@pytest.mark.parametrize(("background"), [False, True])
+def test_log_sink(background):
+    with TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "log.txt")
+        sink = get_log_sink(path, flush_interval=60, background=background)
+        assert get_log_sink(path) is sink
+
+        sink.write("buffered", logging.INFO)
+        if not background:
+            assert open(path).read() == ""
+            sink.write("flushed", logging.WARNING)
+            assert open(path).read() == "buffered\nflushed\n"
+
+        close_log_sinks(tmpdir)
+        assert sink.closed
+        assert open(path).read().startswith("buffered\n")
+        with pytest.raises(ValueError):
+            sink.write("closed")
+        assert get_log_sink(path) is not sink
+        close_log_sinks()
+
+
+def test_log_handler_closes_sink(wps_test_process):
+    process = wps_test_process
+    with TemporaryDirectory() as tmpdir:
+        process.workdir = tmpdir
+        response = TestResponse()
+        for message, step in [("Starting", "start"), ("Step", None)]:
+            log_handler(process, response, message, logger, process_step=step)
+        sink = get_log_sink(os.path.join(tmpdir, "log.txt"))
+
+        log_handler(process, response, "Done", logger, process_step="complete")
+        assert sink.closed
+        assert open(sink.path).read() == "Starting\nStep\nDone\n"
+
+
+def test_closing_log_sinks(wps_test_process):
+    process = wps_test_process
+    with TemporaryDirectory() as tmpdir:
+        process.workdir = tmpdir
+        response = TestResponse()
+        with pytest.raises(ValueError):
+            with closing_log_sinks(process.workdir):
+                log_handler(process, response, "Starting", logger, process_step="start")
+                sink = get_log_sink(os.path.join(tmpdir, "log.txt"))
+                raise ValueError("Failed")
+
+        assert sink.closed
+        assert open(sink.path).read() == "Starting\n"
+
+
+def test_status_throttle():
+    throttle = StatusThrottle(max_per_second=1e-3, min_percentage_change=5)
+
+    assert throttle.allow(20)
+    assert not throttle.allow(21)
+    assert not throttle.allow(22)
+    assert throttle.allow(22, level=logging.WARNING)
+    assert throttle.allow(30)
+    assert throttle.allow(30, process_step="build_output")
+    assert throttle.suppressed == 2
+
+
+def test_log_handler_throttle(wps_test_process):
+    process = wps_test_process
+    response = TestResponse()
+    get_status_throttle(response, max_per_second=1e-3)
+    with TemporaryDirectory() as tmpdir:
+        process.workdir = tmpdir
+        log_handler(process, response, "Starting", logger, process_step="start")
+        for i in range(10):
+            log_handler(process, response, f"Step {i}", logger)
+        assert response.message == "Starting"
+        assert get_status_throttle(response).suppressed == 10
+
+        log_handler(process, response, "Done", logger, process_step="complete")
+        assert response.message == "Done"
+        assert open(os.path.join(tmpdir, "log.txt")).read().count("Step") == 10
+
+
+def test_log_span(wps_test_process):
+    process = wps_test_process
+    response = TestResponse()
+    with TemporaryDirectory() as tmpdir:
+        process.workdir = tmpdir
+        with log_span(process, response, "start", logger):
+            pass
+        with pytest.raises(ValueError):
+            with log_span(process, response, "load", logger):
+                raise ValueError("Failed")
+        with log_span(process, response, "complete", logger, "Done"):
+            pass
+
+        with open(os.path.join(tmpdir, "log.txt")) as log_file:
+            records = [json.loads(line) for line in log_file]
+
+    assert [record["step"] for record in records] == [
+        "start",
+        None,
+        "load",
+        None,
+        "complete",
+        None,
+    ]
+    assert [record.get("outcome") for record in records[1::2]] == [
+        "ok",
+        "error",
+        "ok",
+    ]
+    assert records[0]["elapsed"] is None
+    assert records[2]["elapsed"] >= 0
+    assert records[4]["elapsed"] >= 0
+    assert all(record["process"] == process.identifier for record in records)
+    assert all(record["peak_rss"] > 0 for record in records)
+    assert response.message == "Done"
+
+
+def test_peak_rss_unavailable(monkeypatch):
+    assert peak_rss() > 0
+    # As on platforms without the resource module
+    monkeypatch.setitem(sys.modules, "resource", None)
+    assert peak_rss() is None
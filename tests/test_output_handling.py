@@ -1,13 +1,26 @@
 import pytest
+import re
+import json
+import time
 from netCDF4._netCDF4 import Dataset
+from pkg_resources import resource_filename
+from tempfile import NamedTemporaryFile
 
+from wps_tools import output_handling
 from wps_tools.output_handling import (
     nc_to_dataset,
     json_to_dict,
     txt_to_string,
     auto_construct_outputs,
     get_metalink_content,
+    iter_metalink_content,
+    OutputConstructionError,
+    iter_construct_outputs,
+    iter_json_items,
+    iter_text_lines,
 )
+from wps_tools.file_handling import build_meta_link
+from wps_tools.download import ChecksumMismatchError
 from wps_tools.testing import url_path, local_path
 
 
@@ -26,6 +39,19 @@ def test_nc_to_dataset(url):
     assert len(dataset.dimensions) > 0
 
 
+@pytest.mark.parametrize(("filename"), ["tiny_daily_pr.nc"])
+@pytest.mark.parametrize(("lazy"), [True, False])
+def test_nc_to_dataset_local(http_server, filename, lazy):
+    for url in [f"{http_server}/{filename}", local_path(filename)]:
+        if url.startswith("file") and not lazy:
+            continue
+        dataset = nc_to_dataset(url, lazy=lazy)
+
+        assert isinstance(dataset, Dataset)
+        assert len(dataset.variables) > 0
+        dataset.close()
+
+
 @pytest.mark.parametrize(
     ("url"),
     [local_path("gsl.json")],
@@ -62,8 +88,8 @@ def test_txt_to_string_local(txt_file):
     txt_file.close()
 
 
-def auto_construct_outputs_test(outputs, expected_types):
-    process_outputs = auto_construct_outputs(outputs)
+def auto_construct_outputs_test(outputs, expected_types, max_workers=None):
+    process_outputs = auto_construct_outputs(outputs, max_workers)
     for i in range(len(process_outputs)):
         assert type(process_outputs[i]) == expected_types[i]
 
@@ -100,6 +126,53 @@ def test_auto_construct_outputs_local(txt_file, outputs, expected_types):
     txt_file.close()
 
 
+@pytest.mark.parametrize(
+    ("filenames", "expected_types"),
+    [
+        (
+            ["gsl.json", "tiny_daily_pr.nc", "gsl.json", "test string"],
+            [dict, Dataset, dict, str],
+        )
+    ],
+)
+@pytest.mark.parametrize(("max_workers"), [1, 4])
+def test_auto_construct_outputs_parallel(
+    http_server, filenames, expected_types, max_workers
+):
+    outputs = [
+        f"{http_server}/{filename}" if "." in filename else filename
+        for filename in filenames
+    ]
+    auto_construct_outputs_test(outputs, expected_types, max_workers)
+
+
+def test_auto_construct_outputs_parallel_nc(monkeypatch, http_server):
+    opening = []
+    overlaps = []
+
+    def dataset(path):
+        opening.append(path)
+        overlaps.append(len(opening) > 1)
+        time.sleep(0.01)
+        opening.remove(path)
+        return Dataset(path)
+
+    monkeypatch.setattr(output_handling, "Dataset", dataset)
+    outputs = [f"{http_server}/tiny_daily_pr.nc"] * 4
+    process_outputs = auto_construct_outputs(outputs, max_workers=4)
+
+    assert [type(output) for output in process_outputs] == [Dataset] * 4
+    assert overlaps == [False] * 4
+
+
+@pytest.mark.parametrize(("filename"), ["missing.json"])
+def test_auto_construct_outputs_parallel_err(http_server, filename):
+    url = f"{http_server}/{filename}"
+    with pytest.raises(OutputConstructionError) as e:
+        auto_construct_outputs([local_path("gsl.json"), url], max_workers=2)
+    assert e.value.url == url
+
+
 @pytest.mark.parametrize(
     ("output"),
     ["https://test_metalinks.meta4"],
@@ -107,3 +180,160 @@ def test_auto_construct_outputs_local(txt_file, outputs, expected_types):
 def test_get_metalink_content(mock_metalink, output):
     for file_ in get_metalink_content(output):
         assert file_.endswith((".json", ".nc"))
+
+
+@pytest.mark.parametrize(("output"), ["https://test_metalinks.meta4"])
+@pytest.mark.parametrize(("chunk_size"), [16, 64 * 1024])
+def test_iter_metalink_content(mock_metalink, output, chunk_size):
+    entries = list(iter_metalink_content(output, chunk_size))
+
+    assert [entry["name"] for entry in entries] == ["gsl.json", "tiny_daily_pr.nc"]
+    for entry in entries:
+        assert entry["size"] > 0
+        assert len(entry["urls"]) == 1
+
+
+metalink3 = """<?xml version="1.0" encoding="UTF-8"?>
+<metalink version="3.0" xmlns="http://www.metalinker.org/">
+  <files>
+    <file name="gsl.json">
+      <resources>
+        <url type="http">{json}</url>
+        <url type="http">http://mirror.example.com/gsl.json</url>
+      </resources>
+    </file>
+    <file name="tiny_rules.csv">
+      <resources>
+        <url type="http">{csv}</url>
+      </resources>
+    </file>
+  </files>
+</metalink>
+"""
+
+
+def test_metalink3_one_url_per_file():
+    content = metalink3.format(
+        json=local_path("gsl.json"), csv=local_path("tiny_rules.csv")
+    )
+    with NamedTemporaryFile("w", suffix=".meta4", dir="/tmp") as metalink:
+        metalink.write(content)
+        metalink.flush()
+        url = f"file://{metalink.name}"
+
+        entries = list(iter_metalink_content(url, chunk_size=32))
+        assert [len(entry["urls"]) for entry in entries] == [2, 1]
+        assert get_metalink_content(url) == [
+            local_path("gsl.json"),
+            local_path("tiny_rules.csv"),
+        ]
+        assert [type(output) for output in auto_construct_outputs([url])] == [
+            dict,
+            str,
+        ]
+
+
+@pytest.mark.parametrize(
+    ("outputs", "expected_types"),
+    [
+        (
+            ["first", "https://test_metalinks.meta4", "last"],
+            [str, dict, Dataset, str],
+        )
+    ],
+)
+@pytest.mark.parametrize(("max_workers"), [None, 2])
+def test_auto_construct_outputs_metalink(
+    mock_metalink, outputs, expected_types, max_workers
+):
+    process_outputs = auto_construct_outputs(outputs, max_workers)
+    assert [type(output) for output in process_outputs] == expected_types
+
+
+@pytest.mark.parametrize(("max_workers"), [None, 2])
+def test_iter_construct_outputs_early_stop(http_server, max_workers):
+    outputs = [local_path("gsl.json")] + [f"{http_server}/missing.json"] * 10
+    constructed = iter_construct_outputs(outputs, max_workers)
+
+    assert isinstance(next(constructed), dict)
+    constructed.close()
+
+
+@pytest.mark.parametrize(("outfiles"), [["gsl.json", "tiny_daily_pr.nc"]])
+def test_auto_construct_outputs_checksums(outfiles):
+    metalink = build_meta_link(
+        varname="climo",
+        desc="Climatology",
+        outfiles=outfiles,
+        outdir=resource_filename("tests", "data"),
+        checksums=True,
+    )
+    tampered = re.sub(r'(<hash type="sha-256">)\w+', r"\g<1>" + "0" * 64, metalink)
+
+    with NamedTemporaryFile("w", suffix=".meta4", dir="/tmp") as meta4:
+        meta4.write(metalink)
+        meta4.flush()
+        process_outputs = auto_construct_outputs([f"file://{meta4.name}"])
+    assert [type(output) for output in process_outputs] == [dict, Dataset]
+
+    with NamedTemporaryFile("w", suffix=".meta4", dir="/tmp") as meta4:
+        meta4.write(tampered)
+        meta4.flush()
+        with pytest.raises(ChecksumMismatchError):
+            auto_construct_outputs([f"file://{meta4.name}"])
+
+
+@pytest.mark.parametrize(("chunk_size"), [1, 7, 64 * 1024])
+def test_iter_json_items(http_server, chunk_size):
+    expected = json_to_dict(local_path("gsl.json"))
+    for url in [local_path("gsl.json"), f"{http_server}/gsl.json"]:
+        assert dict(iter_json_items(url, chunk_size)) == expected
+
+    array = [1, -2.5e3, "a,]}", {"b": [None, True]}, [], 10**20]
+    with NamedTemporaryFile("w", suffix=".json", dir="/tmp") as json_file:
+        json.dump(array, json_file, indent=2)
+        json_file.flush()
+        assert list(iter_json_items(f"file://{json_file.name}", chunk_size)) == array
+
+
+def test_iter_json_items_large_item():
+    # A single item spanning many chunks
+    document = {"stations": [{"id": i, "gsl": i * 0.5} for i in range(20000)]}
+    with NamedTemporaryFile("w", suffix=".json", dir="/tmp") as json_file:
+        json.dump(document, json_file)
+        json_file.flush()
+        items = iter_json_items(f"file://{json_file.name}", chunk_size=16)
+        assert dict(items) == document
+
+
+@pytest.mark.parametrize(("content"), ["[1, 2", '{"a" 1}', "[1] 2", "3"])
+def test_iter_json_items_err(content):
+    with NamedTemporaryFile("w", suffix=".json", dir="/tmp") as json_file:
+        json_file.write(content)
+        json_file.flush()
+        with pytest.raises(ValueError):
+            list(iter_json_items(f"file://{json_file.name}", 2))
+
+
+@pytest.mark.parametrize(("chunk_size"), [1, 3, 64 * 1024])
+def test_iter_text_lines(chunk_size):
+    content = "première ligne\r\nsecond line\n\nlast line"
+    with NamedTemporaryFile("wb", suffix=".txt", dir="/tmp") as txt_file:
+        txt_file.write(content.encode("utf-8"))
+        txt_file.flush()
+        url = f"file://{txt_file.name}"
+        assert list(iter_text_lines(url, chunk_size)) == content.splitlines()
+
+        with pytest.raises(ChecksumMismatchError):
+            list(iter_text_lines(url, chunk_size, sha256="0" * 64))
+
+
+def test_auto_construct_outputs_lazy(http_server):
+    outputs = [f"{http_server}/gsl.json", local_path("gsl.json"), "test string"]
+    process_outputs = auto_construct_outputs(outputs, lazy=True)
+
+    assert [type(output) for output in process_outputs[:2]] == [
+        type(iter_json_items(outputs[0]))
+    ] * 2
+    assert process_outputs[2] == "test string"
+    assert dict(process_outputs[0]) == json_to_dict(outputs[1])
@@ -0,0 +1,83 @@
+import pytest
+import time
+import threading
+from pywps.app.exceptions import ProcessError
+from wps_tools.parallel import map_ordered, imap_ordered
+
+
+@pytest.mark.parametrize(("max_workers"), [1, 4])
+def test_map_ordered(max_workers):
+    items = [0.03, 0.01, 0.02, 0.0]
+
+    def delayed(delay):
+        time.sleep(delay)
+        return delay
+
+    assert map_ordered(delayed, items, max_workers) == items
+
+
+def test_map_ordered_group_limit():
+    active = {}
+    peak = {}
+    lock = threading.Lock()
+
+    def track(url):
+        host = url.split("/")[2]
+        with lock:
+            active[host] = active.get(host, 0) + 1
+            peak[host] = max(peak.get(host, 0), active[host])
+        time.sleep(0.01)
+        with lock:
+            active[host] -= 1
+        return url
+
+    urls = [f"http://host{i % 2}/file{i}.nc" for i in range(10)]
+    assert map_ordered(track, urls, 8, group_limit=2) == urls
+    assert max(peak.values()) <= 2
+
+
+def test_map_ordered_err():
+    started = []
+    finished = []
+
+    def fail_first(item):
+        started.append(item)
+        if item == 0:
+            raise ProcessError("Download failed")
+        time.sleep(0.05)
+        finished.append(item)
+        return item
+
+    with pytest.raises(ProcessError):
+        map_ordered(fail_first, range(20), 2)
+    assert len(started) < 20
+    # Calls already running have returned when the error is raised
+    assert len(finished) == len(started) - 1
+
+
+@pytest.mark.parametrize(("max_workers"), [1, 3])
+def test_imap_ordered(max_workers):
+    drawn = []
+
+    def items():
+        for i in range(100):
+            drawn.append(i)
+            yield i
+
+    results = imap_ordered(lambda i: i * 2, items(), max_workers)
+    assert [next(results) for _ in range(5)] == [0, 2, 4, 6, 8]
+    results.close()
+    assert len(drawn) <= 5 + max_workers
+
+
+def test_imap_ordered_err():
+    def fail_on_two(item):
+        if item == 2:
+            raise ProcessError("Download failed")
+        return item
+
+    results = imap_ordered(fail_on_two, range(10), 2)
+    assert next(results) == 0
+    assert next(results) == 1
+    with pytest.raises(ProcessError):
+        next(results)
@@ -0,0 +1,107 @@
+import pytest
+import os
+import time
+import signal
+import operator
+from importlib.util import find_spec
+from pkg_resources import resource_filename
+from wps_tools.r_executor import RExecutor, BrokenWorkerError
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize(("max_workers"), [1, 2])
+def test_r_executor_submit(max_workers):
+    with RExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(operator.add, i, 1) for i in range(10)]
+        assert [future.result(timeout=60) for future in futures] == list(range(1, 11))
+
+
+@pytest.mark.slow
+def test_r_executor_recycling():
+    with RExecutor(max_workers=1, max_tasks_per_worker=1) as executor:
+        pids = [executor.submit(os.getpid).result(timeout=60) for _ in range(3)]
+
+    assert len(set(pids)) == 3
+    assert os.getpid() not in pids
+
+
+@pytest.mark.slow
+def test_r_executor_err():
+    with RExecutor(max_workers=1) as executor:
+        future = executor.submit(operator.truediv, 1, 0)
+        with pytest.raises(ZeroDivisionError):
+            future.result(timeout=60)
+
+        assert executor.submit(operator.truediv, 4, 2).result(timeout=60) == 2
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize(
+    ("r_file", "r_object_name"),
+    [(resource_filename("tests", "data/expected_gsl.rda"), "expected_gsl_vector")],
+)
+def test_r_executor_load_rdata_to_python(r_file, r_object_name):
+    pytest.importorskip("rpy2")
+    with RExecutor(max_workers=1, packages=["base"]) as executor:
+        result = executor.load_rdata_to_python(r_file, r_object_name).result(timeout=60)
+        r2py_object = result.load()
+
+    assert "robjects" in str(type(r2py_object))
+
+
+@pytest.mark.slow
+@pytest.mark.skipif(find_spec("rpy2") is not None, reason="needs rpy2 missing")
+def test_r_executor_broken_at_start():
+    # Workers cannot import R packages without rpy2
+    executor = RExecutor(max_workers=2, packages=["base"])
+    future = executor.submit(operator.add, 1, 2)
+    with pytest.raises(BrokenWorkerError):
+        future.result(timeout=60)
+    with pytest.raises(BrokenWorkerError):
+        executor.submit(operator.add, 1, 2)
+    executor.shutdown()
+
+
+@pytest.mark.slow
+def test_r_executor_shutdown_timeout():
+    executor = RExecutor(max_workers=1)
+    future = executor.submit(time.sleep, 60)
+    while not future.running():
+        time.sleep(0.1)
+
+    start = time.monotonic()
+    executor.shutdown(timeout=1)
+    assert time.monotonic() - start < 30
+    with pytest.raises(BrokenWorkerError):
+        future.result(timeout=0)
+
+
+@pytest.mark.slow
+def test_r_executor_worker_crash():
+    with RExecutor(max_workers=2) as executor:
+        crashed = executor.submit(os._exit, 1)
+        # Keep results flowing from the other worker
+        busy = [executor.submit(time.sleep, 0.01) for _ in range(400)]
+        with pytest.raises(BrokenWorkerError):
+            crashed.result(timeout=60)
+        assert not all(future.done() for future in busy)
+        for future in busy:
+            future.result(timeout=60)
+
+
+@pytest.mark.slow
+def test_r_executor_idle_worker_killed():
+    with RExecutor(max_workers=1) as executor:
+        pid = executor.submit(os.getpid).result(timeout=60)
+        os.kill(pid, signal.SIGKILL)
+
+        # Kill the replacement once ready, before it ran any job
+        deadline = time.monotonic() + 60
+        while not executor._ready - {pid} and time.monotonic() < deadline:
+            time.sleep(0.1)
+        (replacement,) = executor._ready - {pid}
+        os.kill(replacement, signal.SIGKILL)
+        while replacement in executor._workers and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+        assert executor.submit(operator.add, 1, 2).result(timeout=60) == 3
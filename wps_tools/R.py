@@ -1,17 +1,37 @@
-import re
+import os
+import time
+import threading
+from collections import OrderedDict
+import numpy
 from rpy2 import robjects
+from rpy2.robjects import numpy2ri
+from rpy2.robjects.conversion import localconverter
+from rpy2.rinterface import RTYPES
 from rpy2.robjects.packages import isinstalled, importr
 from rpy2.rinterface_lib.embedded import RRuntimeError
 from pywps.app.exceptions import ProcessError
 from tempfile import NamedTemporaryFile
-from urllib.request import urlretrieve
 from pkg_resources import resource_filename
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+from wps_tools.download import download, open_url, file_digest
+from wps_tools.error_handling import custom_process_error
+
+
+# R stores integer and logical NA as the smallest 32-bit integer
+NA_INTEGER = numpy.iinfo(numpy.int32).min
+NA_LOGICAL = NA_INTEGER
+
+_packages = {}
+_package_stats = {"hits": 0, "misses": 0, "import_seconds": {}}
+_package_lock = threading.RLock()
 
 
 def get_package(package):
     """
     Exposes all R objects in package as Python objects after
-    checking that it is installed.
+    checking that it is installed. Packages are imported once per process
+    and later calls return the cached handle.
 
     Parameters:
         package (str): the name of an R package
@@ -19,38 +39,387 @@ def get_package(package):
     Returns:
         Exposed R package
     """
-    if isinstalled(package):
-        return importr(package)
-    else:
-        raise ProcessError(f"R package, {package}, is not installed")
+    with _package_lock:
+        if package in _packages:
+            _package_stats["hits"] += 1
+        else:
+            if not isinstalled(package):
+                raise ProcessError(f"R package, {package}, is not installed")
 
+            start = time.perf_counter()
+            _packages[package] = importr(package)
+            _package_stats["import_seconds"][package] = time.perf_counter() - start
+            _package_stats["misses"] += 1
+        return _packages[package]
 
-def load_rdata_to_python(r_file, r_object_name):
+
+def warm_packages(packages=None):
     """
-    Loads R objects from a .rda or .Rdata file into the embedded R
-    environment, then exposes that object as a Python object.
+    Imports R packages ahead of the first request, e.g. at server start,
+    so that `get_package` only has to look them up.
+
+    Parameters:
+        packages (list): names of R packages, defaults to the comma separated
+            list in the environment variable WPS_TOOLS_R_PACKAGES
+
+    Returns:
+        dict: package names mapped to the seconds spent importing them
+    """
+    if packages is None:
+        packages = [
+            package.strip()
+            for package in os.getenv("WPS_TOOLS_R_PACKAGES", "").split(",")
+            if package.strip()
+        ]
+
+    for package in packages:
+        get_package(package)
+    return {
+        package: _package_stats["import_seconds"].get(package, 0.0)
+        for package in packages
+    }
+
+
+def package_cache_info():
+    """
+    Describes the R package handle cache
+
+    Returns:
+        dict: numbers of cache hits and misses, and the seconds spent
+            importing each cached package
+    """
+    with _package_lock:
+        return {
+            "hits": _package_stats["hits"],
+            "misses": _package_stats["misses"],
+            "import_seconds": dict(_package_stats["import_seconds"]),
+        }
+
+
+class REnvironmentPool:
+    """
+    Named R environments and an LRU cache of loaded rda files
+
+    Every rda file is loaded into its own `new.env()` environment rather
+    than R's global environment, so concurrent requests never overwrite each
+    other's objects. Loaded environments are kept, keyed by file path (or
+    url) and version (modification time and size, or HTTP validators), so
+    reading the same reference dataset again costs nothing until it changes.
+    Objects from cached environments are shared and must not be modified in
+    place.
+
+    Parameters:
+        max_loaded (int): Number of loaded rda files kept in the cache
+    """
+
+    def __init__(self, max_loaded=16):
+        self.max_loaded = max_loaded
+        self.hits = 0
+        self.misses = 0
+        self._envs = {}
+        self._loaded = OrderedDict()
+        self._lock = threading.RLock()
+
+    def environment(self, name):
+        """Return the named R environment, creating it if needed
+
+        Parameters:
+            name (str): Name of the environment, e.g. a request uuid
+
+        Returns:
+            rpy2.robjects.Environment: the environment
+        """
+        with self._lock:
+            if name not in self._envs:
+                self._envs[name] = robjects.r["new.env"]()
+            return self._envs[name]
+
+    def release(self, name):
+        """Drop the named R environment so R can reclaim its objects"""
+        with self._lock:
+            self._envs.pop(name, None)
+
+    def lookup(self, key):
+        """Return the (version, environment, names) cached for key, if any"""
+        with self._lock:
+            entry = self._loaded.get(key)
+            if entry:
+                self._loaded.move_to_end(key)
+            return entry
+
+    def record_hit(self):
+        """Count a use of an environment found with `lookup`"""
+        with self._lock:
+            self.hits += 1
+
+    def load_file(self, r_file, key=None, version=None, cache=True):
+        """Load an rda file into an environment unless it is already loaded
+
+        Parameters:
+            r_file (str): path to an .rda or .rdata file
+            key (str): Cache key, defaults to the absolute path of r_file
+            version (any): Version of the content, defaults to the modification
+                time and size of r_file
+            cache (bool): Whether to keep the loaded environment
+
+        Returns:
+            tuple: the environment and the list of names of its objects
+        """
+        key = key or os.path.abspath(r_file)
+        if version is None:
+            stat = os.stat(r_file)
+            version = (stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            entry = self.lookup(key)
+            if entry and entry[0] == version:
+                self.hits += 1
+                return entry[1], entry[2]
+
+            self.misses += 1
+            env = robjects.r["new.env"]()
+            try:
+                names = list(robjects.r["load"](file=r_file, envir=env))
+            except RRuntimeError as e:
+                custom_process_error(e)
+            if cache:
+                self.store(key, version, env, names)
+            return env, names
+
+    def store(self, key, version, env, names):
+        """Cache a loaded environment, evicting the least recently used ones"""
+        with self._lock:
+            self._loaded[key] = (version, env, names)
+            self._loaded.move_to_end(key)
+            while len(self._loaded) > self.max_loaded:
+                self._loaded.popitem(last=False)
+
+    def clear(self):
+        """Drop every named environment and cached rda file"""
+        with self._lock:
+            self._envs.clear()
+            self._loaded.clear()
+
+
+_environment_pool = None
+
+
+def get_environment_pool():
+    """
+    Return the process-wide R environment pool. The number of rda files kept
+    loaded can be set with the environment variable WPS_TOOLS_R_MAX_LOADED.
+
+    Returns:
+        REnvironmentPool: the shared pool
+    """
+    global _environment_pool
+    if _environment_pool is None:
+        _environment_pool = REnvironmentPool(
+            int(os.getenv("WPS_TOOLS_R_MAX_LOADED", 16))
+        )
+    return _environment_pool
+
+
+def load_rdata_to_python(r_file, r_object_name, as_numpy=False):
+    """
+    Loads R objects from a .rda or .Rdata file into a private R environment
+    of the embedded R, then exposes that object as a Python object. Repeated
+    reads of an unchanged file reuse the environment it was loaded into.
 
     Parameters:
         r_file (str): path to an .rda or .rdata file
         r_object_name (str): name of an R object from the r_file
+        as_numpy (bool): Whether to convert the object with `r_to_numpy`
 
     Returns:
         Exposed R object as a python object
     """
-    try:
-        robjects.r(f"load(file='{r_file}')")
-        obj = robjects.r(r_object_name)
+    return load_rdata_file(r_file, [r_object_name], as_numpy=as_numpy)[r_object_name]
+
+
+def _object_not_found_error(r_object_name, err_type="RRuntimeError"):
+    """Build the ProcessError raised when an object is missing from an rda file
+
+    Parameters:
+        r_object_name (str): name of the missing R object
+        err_type (str): name of the underlying error
+
+    Returns:
+        ProcessError: error describing the missing object
+    """
+    if "_" in r_object_name:
+        return ProcessError(
+            msg=f"{err_type}: The variable name passed is not an object found in the given rda file"
+        )
+    else:
+        return ProcessError(
+            msg=f"{err_type}: There is no object named {r_object_name} in this rda file"
+        )
+
+
+def _select_objects(env, names, r_object_names, as_numpy=False):
+    if r_object_names is None:
+        r_object_names = names
+
+    for name in r_object_names:
+        if name not in names:
+            raise _object_not_found_error(name)
+
+    if as_numpy:
+        return {name: r_to_numpy(env[name]) for name in r_object_names}
+    return {name: env[name] for name in r_object_names}
+
+
+def load_rdata_file(r_file, r_object_names=None, pool=None, as_numpy=False):
+    """
+    Loads an .rda or .Rdata file once into a private R environment and
+    exposes its objects as Python objects. The global R environment is
+    left untouched.
+
+    Parameters:
+        r_file (str): path to an .rda or .rdata file
+        r_object_names (list): names of the R objects to return, all objects
+            in the file if None
+        pool (REnvironmentPool): Pool of loaded environments, defaults to
+            the one returned by `get_environment_pool`
+        as_numpy (bool): Whether to convert the objects with `r_to_numpy`
+
+    Returns:
+        dict: R object names mapped to the exposed objects, in file order
+            unless r_object_names gives another order
+    """
+    pool = pool or get_environment_pool()
+    env, names = pool.load_file(r_file)
+    return _select_objects(env, names, r_object_names, as_numpy)
+
+
+def load_rdata(url, r_object_names=None, pool=None, as_numpy=False):
+    """
+    Downloads an rda url file once and loads it once, returning all (or the
+    requested) objects it contains. Local files are reused while unchanged
+    and http files while the server confirms, via their ETag or Last-Modified
+    validators, that they have not changed.
+
+    Parameters:
+        url (str): file or http url path to a rda file
+        r_object_names (list): names of the R objects to return, all objects
+            in the file if None
+        pool (REnvironmentPool): Pool of loaded environments, defaults to
+            the one returned by `get_environment_pool`
+        as_numpy (bool): Whether to convert the objects with `r_to_numpy`
+
+    Returns:
+        dict: R object names mapped to Rpy2 objects
+    """
+    pool = pool or get_environment_pool()
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https"):
+        r_file = url2pathname(parsed.path) if parsed.scheme == "file" else url
+        return load_rdata_file(r_file, r_object_names, pool, as_numpy)
+
+    entry = pool.lookup(url)
+    headers = {}
+    if entry:
+        etag, last_modified = entry[0]
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+    response = open_url(url, headers)
+    if response.status_code == 304 and entry:
+        response.close()
+        pool.record_hit()
+        return _select_objects(entry[1], entry[2], r_object_names, as_numpy)
+
+    with NamedTemporaryFile(
+        suffix=".rda", prefix="tmp_copy", dir="/tmp", delete=True, mode="wb"
+    ) as r_file:
+        result = download(url, r_file, response=response)
+        validators = (result.headers.get("ETag"), result.headers.get("Last-Modified"))
+        env, names = pool.load_file(
+            r_file.name, key=url, version=validators, cache=any(validators)
+        )
+    return _select_objects(env, names, r_object_names, as_numpy)
+
+
+def r_to_numpy(obj, copy=True):
+    """
+    Converts an R object to NumPy without crossing the R/Python boundary per
+    element. Numeric and logical vectors are read through their memory
+    buffer, matrices and arrays keep their dimensions, factors become arrays
+    of their labels, data.frames and named lists become dicts and unnamed
+    lists become lists. Other objects are returned unchanged.
+
+    Integer and logical vectors keep their int32 and bool dtypes whatever
+    their values; when they hold NA, as do factors, they are returned as
+    `numpy.ma.MaskedArray` with the NA elements masked. NA in double vectors
+    is already NaN.
+
+    Parameters:
+        obj (Rpy2 object): R object to convert
+        copy (bool): Whether numeric arrays copy the R memory. Views
+            (copy=False) are only valid while the R object is alive.
+
+    Returns:
+        numpy.ndarray, dict or list: the converted object
+    """
+    typeof = getattr(obj, "typeof", None)
+    if typeof == RTYPES.VECSXP:
+        items = [r_to_numpy(item, copy) for item in obj]
+        names = _r_names(obj)
+        return dict(zip(names, items)) if names else items
+
+    if typeof in (RTYPES.REALSXP, RTYPES.INTSXP, RTYPES.LGLSXP):
+        view = obj.memoryview() if hasattr(obj, "memoryview") else list(obj)
+        array = numpy.array(view) if copy else numpy.asarray(view)
+        na = array == NA_INTEGER if typeof != RTYPES.REALSXP else None
+        if "factor" in _r_class(obj):
+            # NA codes index a placeholder label, masked below
+            levels = list(robjects.r["levels"](obj)) or [""]
+            array = numpy.array(levels, dtype=str)[numpy.where(na, 1, array) - 1]
+        elif typeof == RTYPES.LGLSXP:
+            array = array == 1
+        if na is not None and na.any():
+            array = numpy.ma.masked_array(array, mask=na)
+    elif typeof == RTYPES.STRSXP:
+        array = numpy.array(list(obj), dtype=str)
+    else:
         return obj
-    except RRuntimeError as e:
-        err_name = re.compile(r"object \'(.*)\' not found").findall(str(e))
-        if "_" in err_name[0]:
-            raise ProcessError(
-                msg=f"{type(e).__name__}: The variable name passed is not an object found in the given rda file"
-            )
-        else:
-            raise ProcessError(
-                msg=f"{type(e).__name__}: There is no object named {err_name[0]} in this rda file"
-            )
+
+    dims = robjects.r["dim"](obj)
+    if dims is not robjects.NULL and len(dims) > 1:
+        array = array.reshape(tuple(dims), order="F")
+    return array
+
+
+def numpy_to_r(value):
+    """
+    Converts NumPy arrays (or dicts of arrays) to R objects with a single
+    buffer copy using rpy2's numpy converter.
+
+    Parameters:
+        value (numpy.ndarray or dict): array or mapping of names to arrays
+
+    Returns:
+        Rpy2 object: R vector, matrix or array, or a named list for dicts
+    """
+    if isinstance(value, dict):
+        return robjects.ListVector(
+            {name: numpy_to_r(item) for name, item in value.items()}
+        )
+
+    with localconverter(robjects.default_converter + numpy2ri.converter):
+        return robjects.conversion.py2rpy(value)
+
+
+def _r_class(obj):
+    return list(robjects.r["class"](obj))
+
+
+def _r_names(obj):
+    names = robjects.r["names"](obj)
+    return None if names is robjects.NULL else list(names)
 
 
 def save_python_to_rdata(r_name, py_var, r_file):
@@ -59,11 +428,16 @@ def save_python_to_rdata(r_name, py_var, r_file):
 
     Parameters:
         r_name (str): name to give the oject in the R environment
-        py_var (any type): python variable to save to the R environment
+        py_var (any type): python variable to save to the R environment,
+            NumPy arrays and dicts of arrays are converted with `numpy_to_r`
         r_file (str): path to rdata file
     """
-    robjects.r.assign(r_name, py_var)
-    robjects.r(f"save({r_name}, file='{r_file}')")
+    if isinstance(py_var, (numpy.ndarray, dict)):
+        py_var = numpy_to_r(py_var)
+
+    env = robjects.r["new.env"]()
+    env[r_name] = py_var
+    robjects.r["save"](list=r_name, file=r_file, envir=env)
 
 
 def r_valid_name(robj_name):
@@ -78,31 +452,26 @@ def r_valid_name(robj_name):
         raise ProcessError(msg="Your vector name is not a valid R name")
 
 
-def rda_to_vector(url, vector_name):
+def rda_to_vector(url, vector_name, as_numpy=False):
     """
     Access content from a rda url file as a Rpy2 vector object
     Parameters:
         url (str): file or http url path to a rda file
         vector_name (str): the name the vector was given when it
             was saved to the rda file
+        as_numpy (bool): Whether to return the vector as NumPy, see `r_to_numpy`
     Returns:
         Rpy2 object: Rpy2 representation of the R object "vector_name"
     """
-    with NamedTemporaryFile(
-        suffix=".rda", prefix="tmp_copy", dir="/tmp", delete=True, mode="wb"
-    ) as r_file:
-        urlretrieve(url, r_file.name)
-        vector = load_rdata_to_python(r_file.name, vector_name)
-
-    return vector
+    return load_rdata(url, [vector_name], as_numpy=as_numpy)[vector_name]
 
 
 def construct_r_out(outputs):
-    """Build list of R outputs"""
+    """Build list of R outputs, downloading and loading each rda file once"""
     r_out = []
     for value in outputs:
         if value.endswith(".rda") or value.endswith(".rdata"):
-            r_out.append([rda_to_vector(value, obj) for obj in get_robjects(value)])
+            r_out.append(list(load_rdata(value).values()))
     return r_out
 
 
@@ -116,24 +485,114 @@ def get_robjects(url):
     Returns:
         list: a list of the names of objects stored in an rda file
     """
-    with NamedTemporaryFile(
-        suffix=".rda", prefix="tmp_copy", dir="/tmp", delete=True, mode="wb"
-    ) as r_file:
-        urlretrieve(url, r_file.name)
-        robjs = list(robjects.r(f"load(file='{r_file.name}')"))
+    return list(load_rdata(url))
 
-    return robjs
 
+def compare_r_objects(actual, expected, rtol=0.0, atol=0.0, max_report=5, path=""):
+    """
+    Compares objects converted by `r_to_numpy` with vectorized operations.
+    Numeric arrays are compared with the given tolerances and NaN equal to
+    NaN, other arrays for equality, and dicts and lists recursively.
 
-def test_rda_output(url, vector_name, expected_file, expected_vector_name):
-    """Testing method to check rda results"""
-    output_vector = rda_to_vector(url, vector_name)
+    Parameters:
+        actual (numpy.ndarray, dict or list): object to check
+        expected (numpy.ndarray, dict or list): reference object
+        rtol (float): relative tolerance for numeric values
+        atol (float): absolute tolerance for numeric values
+        max_report (int): number of mismatching indices reported
+        path (str): location of the objects within their parents
+
+    Raises:
+        AssertionError: describing the first mismatch
+    """
+    where = f" at {path}" if path else ""
+    if isinstance(expected, dict):
+        assert isinstance(actual, dict), f"Expected a named list{where}"
+        assert list(actual) == list(
+            expected
+        ), f"Names differ{where}: {list(actual)} != {list(expected)}"
+        for name in expected:
+            compare_r_objects(
+                actual[name], expected[name], rtol, atol, max_report, f"{path}${name}"
+            )
+
+    elif isinstance(expected, list):
+        assert isinstance(actual, list), f"Expected a list{where}"
+        assert len(actual) == len(
+            expected
+        ), f"Lengths differ{where}: {len(actual)} != {len(expected)}"
+        for index, (item, expected_item) in enumerate(zip(actual, expected)):
+            compare_r_objects(
+                item, expected_item, rtol, atol, max_report, f"{path}[[{index + 1}]]"
+            )
+
+    elif isinstance(expected, numpy.ndarray):
+        actual = numpy.asarray(actual)
+        assert (
+            actual.shape == expected.shape
+        ), f"Shapes differ{where}: {actual.shape} != {expected.shape}"
+        numeric = numpy.issubdtype(expected.dtype, numpy.number) and (
+            numpy.issubdtype(actual.dtype, numpy.number)
+        )
+        if numeric:
+            equal = numpy.isclose(
+                actual, expected, rtol=rtol, atol=atol, equal_nan=True
+            )
+        else:
+            equal = actual == expected
+
+        if not equal.all():
+            indices = [
+                tuple(index.tolist()) for index in numpy.argwhere(~equal)[:max_report]
+            ]
+            raise AssertionError(
+                f"{(~equal).sum()} of {equal.size} values differ{where}, first at "
+                f"{indices}: {[actual[i].tolist() for i in indices]} != "
+                f"{[expected[i].tolist() for i in indices]}"
+            )
+
+    else:
+        assert str(actual) == str(expected), f"{actual} != {expected}{where}"
+
+
+def test_rda_output(
+    url,
+    vector_name,
+    expected_file,
+    expected_vector_name,
+    vectorized=False,
+    rtol=0.0,
+    atol=0.0,
+):
+    """Testing method to check rda results
+
+    The vectorized mode downloads the output once, skips the comparison when
+    it is byte-identical to the expected file, and otherwise compares both
+    objects as arrays with `compare_r_objects`.
+    """
     local_path = resource_filename("tests", f"data/{expected_file}")
+    if vectorized:
+        with NamedTemporaryFile(
+            suffix=".rda", prefix="tmp_copy", dir="/tmp", delete=True, mode="wb"
+        ) as r_file:
+            result = download(url, r_file, digest="sha256")
+            if vector_name == expected_vector_name and result.digest == file_digest(
+                local_path
+            ):
+                return
+
+            env, names = get_environment_pool().load_file(r_file.name, cache=False)
+            output = _select_objects(env, names, [vector_name], as_numpy=True)
+
+        expected = load_rdata_file(local_path, [expected_vector_name], as_numpy=True)
+        compare_r_objects(
+            output[vector_name], expected[expected_vector_name], rtol, atol
+        )
+        return
+
+    output_vector = rda_to_vector(url, vector_name)
     expected_url = f"file://{local_path}"
     expected_vector = rda_to_vector(expected_url, expected_vector_name)
 
     for index in range(len(expected_vector)):
         assert str(output_vector[index]) == str(expected_vector[index])
-
-    # Clear R global env
-    robjects.r("rm(list=ls())")
@@ -0,0 +1,161 @@
+"""Asyncio counterparts of the wps_tools I/O helpers
+
+Each coroutine runs the corresponding blocking helper in a bounded thread
+pool shared by the whole process, so that an event loop can fan out many
+fetches with `asyncio.gather` while they all reuse the pooled session of
+`wps_tools.download`. The pool has as many threads as the session has
+connections per host (WPS_TOOLS_HTTP_POOL_SIZE), unless set otherwise with
+WPS_TOOLS_AIO_WORKERS.
+
+The embedded R interpreter is not thread-safe, so R helpers run one at a
+time in a dedicated thread.
+
+Cancelling a coroutine stops waiting for its call; a call that has not
+started yet is never run, while one already running completes in its thread.
+"""
+# Library imports
+import os
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Tool imports
+from wps_tools import file_handling, output_handling
+
+_executor = None
+_r_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Return the thread pool running the blocking I/O helpers
+
+    Returns:
+        concurrent.futures.ThreadPoolExecutor: the shared pool
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            max_workers = int(
+                os.getenv(
+                    "WPS_TOOLS_AIO_WORKERS", os.getenv("WPS_TOOLS_HTTP_POOL_SIZE", 16)
+                )
+            )
+            _executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="wps_tools_aio"
+            )
+    return _executor
+
+
+def _get_r_executor():
+    global _r_executor
+    with _executor_lock:
+        if _r_executor is None:
+            _r_executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="wps_tools_aio_r"
+            )
+    return _r_executor
+
+
+async def run(func, *args, executor=None, **kwargs):
+    """Await func(*args, **kwargs) run in a thread of the shared pool
+
+    Parameters:
+        func (callable): Blocking function to call
+        *args, **kwargs: Arguments of func
+        executor (concurrent.futures.Executor): Pool to use instead of the
+            shared one
+
+    Returns:
+        the result of func
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor or get_executor(), functools.partial(func, *args, **kwargs)
+    )
+
+
+async def url_handler(workdir, url, cache=None, sha256=None):
+    """Async `wps_tools.file_handling.url_handler`"""
+    return await run(file_handling.url_handler, workdir, url, cache, sha256)
+
+
+async def is_opendap_url(url, probe_cache=None):
+    """Async `wps_tools.file_handling.is_opendap_url`"""
+    return await run(file_handling.is_opendap_url, url, probe_cache)
+
+
+async def copy_http_content(http, file, chunk_size=None, sha256=None):
+    """Async `wps_tools.file_handling.copy_http_content`"""
+    return await run(file_handling.copy_http_content, http, file, chunk_size, sha256)
+
+
+async def nc_to_dataset(url, lazy=False, sha256=None):
+    """Async `wps_tools.output_handling.nc_to_dataset`"""
+    return await run(output_handling.nc_to_dataset, url, lazy, sha256)
+
+
+async def json_to_dict(url, sha256=None):
+    """Async `wps_tools.output_handling.json_to_dict`"""
+    return await run(output_handling.json_to_dict, url, sha256)
+
+
+async def txt_to_string(url, sha256=None):
+    """Async `wps_tools.output_handling.txt_to_string`"""
+    return await run(output_handling.txt_to_string, url, sha256)
+
+
+async def get_metalink_content(url):
+    """Async `wps_tools.output_handling.get_metalink_content`"""
+    return await run(output_handling.get_metalink_content, url)
+
+
+async def rda_to_vector(url, vector_name, as_numpy=False):
+    """Async `wps_tools.R.rda_to_vector`, run in the R thread"""
+    from wps_tools.R import rda_to_vector
+
+    return await run(
+        rda_to_vector, url, vector_name, as_numpy, executor=_get_r_executor()
+    )
+
+
+async def construct_output(value, sha256=None, lazy=False):
+    """Async `wps_tools.output_handling.construct_output`"""
+    return await run(output_handling.construct_output, value, sha256, lazy)
+
+
+async def auto_construct_outputs(outputs, max_concurrency=None, lazy=False):
+    """Async `wps_tools.output_handling.auto_construct_outputs`
+
+    Metalinks are read first, then every output is constructed concurrently.
+    The first failure cancels the outputs not yet started and is raised.
+
+    Parameters:
+        outputs (list): list of file or http url paths to files
+        max_concurrency (int): Maximum number of outputs constructed at once.
+            They all run in the shared pool, so at most as many as it has
+            threads (WPS_TOOLS_AIO_WORKERS) are constructed at once, whether
+            max_concurrency is None or larger
+        lazy (bool): whether to construct json and txt outputs as iterators,
+            see `wps_tools.output_handling.construct_output`
+
+    Returns:
+        list: the constructed python objects, in the order of outputs
+    """
+    entries = await run(list, output_handling.iter_output_entries(outputs))
+    semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+
+    async def construct(value, sha256):
+        if semaphore is None:
+            return await construct_output(value, sha256, lazy)
+        async with semaphore:
+            return await construct_output(value, sha256, lazy)
+
+    tasks = [asyncio.ensure_future(construct(*entry)) for entry in entries]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
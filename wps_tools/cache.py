@@ -0,0 +1,613 @@
+"""Caches for remote process inputs
+
+Downloaded files are stored once under their sha-256 content digest in
+`<cache_dir>/objects` and every URL that resolved to that content has a small
+JSON entry in `<cache_dir>/urls` holding the HTTP validators (ETag and
+Last-Modified) needed to revalidate it. Files handed to a process are
+hardlinks (or symlinks) into the object store rather than fresh copies.
+
+OPeNDAP classifications made by `is_opendap_url` are memoized in memory by an
+`OpendapProbeCache`.
+"""
+# Library imports
+import os
+import json
+import errno
+import time
+import shutil
+import hashlib
+import threading
+from collections import defaultdict, Counter, OrderedDict
+from contextlib import contextmanager
+from tempfile import NamedTemporaryFile
+from urllib.parse import urlparse
+
+# Tool imports
+from wps_tools.download import ChecksumMismatchError, download, open_url, verify_digest
+
+
+class CacheStats:
+    """Counters describing how a `DownloadCache` has been used
+
+    Attributes:
+        hits (int): Requests served from the cache after revalidation
+        misses (int): Requests that required a full download
+        revalidations (int): Conditional requests sent to the server
+        bytes_saved (int): Bytes not downloaded thanks to the cache
+        evictions (int): Entries removed to respect the size limit
+    """
+
+    fields = ("hits", "misses", "revalidations", "bytes_saved", "evictions")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        for field in self.fields:
+            setattr(self, field, 0)
+
+    def increment(self, field, amount=1):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + amount)
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.fields}
+
+    def __repr__(self):
+        return f"CacheStats({self.as_dict()})"
+
+
+class DownloadCache:
+    """Content-addressed download cache with conditional revalidation
+
+    Each request for a cached URL is sent with `If-None-Match` and
+    `If-Modified-Since` headers; a `304 Not Modified` reply is served from
+    the object store. Once the store grows past `max_bytes`, the least
+    recently used URL entries are evicted together with any object no
+    longer referenced by an entry. Several processes may share cache_dir:
+    files are replaced atomically and files removed by another process are
+    skipped.
+
+    Parameters:
+        cache_dir (str): Directory holding the cache (created if missing)
+        max_bytes (int): Size limit of the object store, unbounded if None
+        link (str): How files are placed in the workdir, one of
+            "hardlink", "symlink" or "copy". Links fall back to the next
+            option when the filesystem does not support them. Symlinks
+            dangle once their object is evicted, so with "symlink" the
+            cache must not be evicted while workdirs still use its files.
+        timeout (float): Timeout in seconds for the HTTP requests
+    """
+
+    link_modes = ("hardlink", "symlink", "copy")
+    # Errors meaning that a kind of link is not supported by the filesystem
+    _link_errnos = {errno.EXDEV, errno.EPERM, errno.ENOTSUP, errno.EMLINK}
+
+    def __init__(self, cache_dir, max_bytes=None, link="hardlink", timeout=60):
+        if link not in self.link_modes:
+            raise ValueError(
+                f'Invalid link argument "{link}": must be one of {self.link_modes}'
+            )
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.link = link
+        self.timeout = timeout
+        self.stats = CacheStats()
+        self._objects_dir = os.path.join(cache_dir, "objects")
+        self._urls_dir = os.path.join(cache_dir, "urls")
+        os.makedirs(self._objects_dir, exist_ok=True)
+        os.makedirs(self._urls_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # Lock and number of users of each url being fetched
+        self._url_locks = {}
+        # Objects being placed in a workdir, which eviction must not remove
+        self._pins = Counter()
+
+    def fetch(self, url, dest, sha256=None):
+        """Place the content of url at dest, downloading only if needed
+
+        Parameters:
+            url (str): http(s) url to fetch
+            dest (str): Path of the file to create in the workdir
+            sha256 (str): Expected sha-256 hex digest of the content, see `get`
+
+        Returns:
+            str: dest
+        """
+        with self._checkout(url, sha256) as blob:
+            self._place(blob, dest)
+        return dest
+
+    def get(self, url, sha256=None):
+        """Return the path of the cached object holding the content of url
+
+        The cached copy is revalidated against the server and refreshed if it
+        is stale or missing.
+
+        When the sha-256 digest of the content is known in advance (e.g. from
+        a metalink), it is used as the cache key: an object with that digest
+        is returned without contacting the server, whatever url it was first
+        downloaded from. Otherwise the content is verified against it and
+        ChecksumMismatchError is raised if they differ.
+
+        Parameters:
+            url (str): http(s) url to fetch
+            sha256 (str): Expected sha-256 hex digest of the content
+
+        Returns:
+            str: Path to the read-only object in the cache
+        """
+        key = self._url_key(url)
+        with self._url_lock(key):
+            entry = self._read_entry(key)
+            if sha256 and (not entry or entry["digest"] != sha256.lower()):
+                entry = self._entry_for_digest(url, sha256.lower()) or entry
+
+            if entry and sha256 and entry["digest"] == sha256.lower():
+                self.stats.increment("hits")
+                self.stats.increment("bytes_saved", entry["size"])
+                entry["last_access"] = time.time()
+                self._write_entry(key, entry)
+                self.evict(keep=key)
+                return self._object_path(entry["digest"])
+
+            headers = self._conditional_headers(entry)
+            if headers:
+                self.stats.increment("revalidations")
+
+            response = open_url(url, headers, timeout=self.timeout)
+            if response.status_code == 304 and entry:
+                response.close()
+                self.stats.increment("hits")
+                self.stats.increment("bytes_saved", entry["size"])
+            else:
+                self.stats.increment("misses")
+                entry = self._store(url, response)
+
+            try:
+                verify_digest(url, entry["digest"], sha256)
+            except ChecksumMismatchError:
+                self._discard(key, entry["digest"])
+                raise
+
+            entry["last_access"] = time.time()
+            self._write_entry(key, entry)
+
+        self.evict(keep=key)
+        return self._object_path(entry["digest"])
+
+    def evict(self, max_bytes=None, keep=None):
+        """Remove least recently used entries until the cache fits max_bytes
+
+        Parameters:
+            max_bytes (int): Size limit, defaults to the cache's max_bytes
+            keep (str): Key of an entry that must not be evicted
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        if max_bytes is None:
+            return
+
+        with self._lock:
+            entries = self._entries()
+            referenced = defaultdict(set)
+            for key, entry in entries.items():
+                referenced[entry["digest"]].add(key)
+
+            sizes = self._object_sizes()
+            total = sum(sizes.values())
+            lru = sorted(entries.items(), key=lambda item: item[1]["last_access"])
+            for key, entry in lru:
+                if total <= max_bytes:
+                    break
+                if key == keep or entry["digest"] in self._pins:
+                    continue
+
+                try:
+                    os.remove(self._entry_path(key))
+                except FileNotFoundError:
+                    # Evicted by another process sharing the cache
+                    pass
+                else:
+                    self.stats.increment("evictions")
+                digest = entry["digest"]
+                referenced[digest].discard(key)
+                if not referenced[digest] and digest in sizes:
+                    self._remove_object(digest)
+                    total -= sizes.pop(digest)
+
+            # Objects left behind by interrupted writes or removed entries
+            for digest in set(sizes) - set(referenced) - set(self._pins):
+                if total <= max_bytes:
+                    break
+                self._remove_object(digest)
+                total -= sizes.pop(digest)
+
+    def clear(self):
+        """Remove every entry and object from the cache"""
+        self.evict(max_bytes=0)
+
+    @property
+    def size(self):
+        """Total size in bytes of the objects in the cache"""
+        return sum(self._object_sizes().values())
+
+    def _store(self, url, response):
+        with NamedTemporaryFile(
+            dir=self._objects_dir, prefix=".tmp_", delete=False
+        ) as tmp_file:
+            try:
+                result = download(
+                    url,
+                    tmp_file,
+                    digest="sha256",
+                    response=response,
+                    timeout=self.timeout,
+                )
+            except BaseException:
+                os.remove(tmp_file.name)
+                raise
+
+        hexdigest = result.digest
+        object_path = self._object_path(hexdigest)
+        if os.path.exists(object_path):
+            # Same content already cached under another url
+            os.remove(tmp_file.name)
+        else:
+            os.chmod(tmp_file.name, 0o444)
+            os.replace(tmp_file.name, object_path)
+
+        return {
+            "url": url,
+            "digest": hexdigest,
+            "size": result.size,
+            "etag": result.headers.get("ETag"),
+            "last_modified": result.headers.get("Last-Modified"),
+        }
+
+    def _entry_for_digest(self, url, digest):
+        """Entry for url pointing to an already stored object, if any"""
+        try:
+            size = os.stat(self._object_path(digest)).st_size
+        except FileNotFoundError:
+            return None
+        return {
+            "url": url,
+            "digest": digest,
+            "size": size,
+            "etag": None,
+            "last_modified": None,
+        }
+
+    @contextmanager
+    def _checkout(self, url, sha256=None):
+        """Get the object of url and keep it from being evicted in the block"""
+        while True:
+            blob = self.get(url, sha256)
+            digest = os.path.basename(blob)
+            with self._lock:
+                # Unless another thread evicted it in between
+                if os.path.exists(blob):
+                    self._pins[digest] += 1
+                    break
+
+        try:
+            yield blob
+        finally:
+            with self._lock:
+                self._pins[digest] -= 1
+                if not self._pins[digest]:
+                    del self._pins[digest]
+
+    def _place(self, blob, dest):
+        if not os.path.exists(blob):
+            # Rather than leaving a dangling symlink at dest
+            raise FileNotFoundError(errno.ENOENT, "Cached object is missing", blob)
+        if os.path.lexists(dest):
+            os.remove(dest)
+
+        modes = self.link_modes[self.link_modes.index(self.link) :]
+        for mode in modes:
+            try:
+                if mode == "hardlink":
+                    os.link(blob, dest)
+                elif mode == "symlink":
+                    os.symlink(os.path.abspath(blob), dest)
+                else:
+                    shutil.copyfile(blob, dest)
+                return
+            except OSError as e:
+                if mode == modes[-1] or e.errno not in self._link_errnos:
+                    raise
+
+    @staticmethod
+    def _conditional_headers(entry):
+        headers = {}
+        if entry:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    @staticmethod
+    def _url_key(url):
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    @contextmanager
+    def _url_lock(self, key):
+        """Hold the lock of a url, dropping it once no thread uses it"""
+        with self._lock:
+            holder = self._url_locks.setdefault(key, [threading.Lock(), 0])
+            holder[1] += 1
+        try:
+            with holder[0]:
+                yield
+        finally:
+            with self._lock:
+                holder[1] -= 1
+                if not holder[1]:
+                    del self._url_locks[key]
+
+    def _object_path(self, digest):
+        return os.path.join(self._objects_dir, digest)
+
+    def _entry_path(self, key):
+        return os.path.join(self._urls_dir, f"{key}.json")
+
+    def _read_entry(self, key):
+        """Read an entry, ignoring it if its object has been removed"""
+        try:
+            with open(self._entry_path(key), encoding="utf8") as entry_file:
+                entry = json.load(entry_file)
+        except (OSError, ValueError):
+            return None
+
+        if not os.path.exists(self._object_path(entry["digest"])):
+            return None
+        return entry
+
+    def _write_entry(self, key, entry):
+        with NamedTemporaryFile(
+            "w", dir=self._urls_dir, prefix=".tmp_", delete=False, encoding="utf8"
+        ) as tmp_file:
+            json.dump(entry, tmp_file)
+        os.replace(tmp_file.name, self._entry_path(key))
+
+    def _discard(self, key, digest):
+        """Remove the entry of key, and its object unless still referenced"""
+        with self._lock:
+            try:
+                os.remove(self._entry_path(key))
+            except FileNotFoundError:
+                pass
+            referenced = {entry["digest"] for entry in self._entries().values()}
+            if digest not in referenced:
+                self._remove_object(digest)
+
+    def _entries(self):
+        entries = {}
+        for dir_entry in os.scandir(self._urls_dir):
+            if dir_entry.name.endswith(".json") and not dir_entry.name.startswith("."):
+                key = dir_entry.name[: -len(".json")]
+                try:
+                    with open(dir_entry.path, encoding="utf8") as entry_file:
+                        entries[key] = json.load(entry_file)
+                except (OSError, ValueError):
+                    continue
+        return entries
+
+    def _object_sizes(self):
+        sizes = {}
+        for dir_entry in os.scandir(self._objects_dir):
+            if not dir_entry.name.startswith("."):
+                try:
+                    sizes[dir_entry.name] = dir_entry.stat().st_size
+                except FileNotFoundError:
+                    continue
+        return sizes
+
+    def _remove_object(self, digest):
+        try:
+            os.remove(self._object_path(digest))
+        except FileNotFoundError:
+            pass
+
+
+_download_cache = None
+
+
+def set_download_cache(cache):
+    """Set the process-wide cache used by `url_handler` and `collect_args`
+
+    Parameters:
+        cache (DownloadCache): Cache to use, or None to disable caching
+    """
+    global _download_cache
+    _download_cache = cache
+
+
+def get_download_cache():
+    """Return the process-wide download cache
+
+    Unless one was set with `set_download_cache`, a cache is created from the
+    environment variables:
+        WPS_TOOLS_CACHE_DIR: directory of the cache (caching is disabled
+            when unset)
+        WPS_TOOLS_CACHE_MAX_BYTES: size limit of the cache
+        WPS_TOOLS_CACHE_LINK: hardlink/symlink/copy
+
+    Returns:
+        DownloadCache: the shared cache, or None if caching is disabled
+    """
+    global _download_cache
+    if _download_cache is None and os.getenv("WPS_TOOLS_CACHE_DIR"):
+        max_bytes = os.getenv("WPS_TOOLS_CACHE_MAX_BYTES")
+        _download_cache = DownloadCache(
+            os.getenv("WPS_TOOLS_CACHE_DIR"),
+            max_bytes=int(max_bytes) if max_bytes else None,
+            link=os.getenv("WPS_TOOLS_CACHE_LINK", "hardlink"),
+        )
+    return _download_cache
+
+
+class ProbeStats(CacheStats):
+    """Counters describing how an `OpendapProbeCache` has been used
+
+    Attributes:
+        hits (int): Classifications answered by a memoized result
+        rule_hits (int): Classifications answered by a per-host rule
+        misses (int): Classifications that required a probe
+        rules_learned (int): Per-host rules learned from probes
+    """
+
+    fields = ("hits", "rule_hits", "misses", "rules_learned")
+
+
+class OpendapProbeCache:
+    """Memo of OPeNDAP classifications with per-host learned rules
+
+    Results of `is_opendap_url` are kept for `ttl` seconds. When a probe
+    confirms what a THREDDS service segment of the url implies (e.g. a
+    `dodsC/` url is OPeNDAP, a `fileServer/` url is not), a rule is learned
+    for the host and path prefix up to that segment so that every other url
+    under it is classified without a probe.
+
+    Parameters:
+        ttl (float): Seconds a memoized result stays valid
+        max_entries (int): Maximum number of memoized results
+        services (dict): Path segments identifying a service, mapped to
+            whether urls under them are OPeNDAP
+    """
+
+    thredds_services = {"dodsC": True, "fileServer": False}
+
+    def __init__(self, ttl=3600, max_entries=10000, services=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.services = self.thredds_services if services is None else services
+        self.stats = ProbeStats()
+        self._lock = threading.Lock()
+        self._results = OrderedDict()
+        self._rules = {}
+
+    def lookup(self, url):
+        """Return the known classification of url, or None if it must be probed
+
+        Parameters:
+            url (str): Url to classify
+
+        Returns:
+            bool: True if url is OPeNDAP, False if not, None if unknown
+        """
+        with self._lock:
+            memo = self._results.get(url)
+            if memo and memo[1] > time.monotonic():
+                self._results.move_to_end(url)
+                self.stats.increment("hits")
+                return memo[0]
+
+            rule = self._match_rule(url)
+            if rule is not None:
+                self.stats.increment("rule_hits")
+                return rule
+
+            self.stats.increment("misses")
+            return None
+
+    def store(self, url, is_opendap):
+        """Memoize the probed classification of url and learn from it
+
+        Parameters:
+            url (str): Probed url
+            is_opendap (bool): Result of the probe
+        """
+        with self._lock:
+            self._results[url] = (is_opendap, time.monotonic() + self.ttl)
+            self._results.move_to_end(url)
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+
+            parsed = urlparse(url)
+            segments = parsed.path.split("/")
+            for index, segment in enumerate(segments):
+                if self.services.get(segment) is is_opendap:
+                    prefix = "/".join(segments[: index + 1]) + "/"
+                    if (parsed.netloc, prefix) not in self._rules:
+                        self._rules[(parsed.netloc, prefix)] = is_opendap
+                        self.stats.increment("rules_learned")
+                    break
+
+    def add_rule(self, host, prefix="/", is_opendap=True):
+        """Classify every url of host whose path starts with prefix
+
+        Parameters:
+            host (str): Host (and port) of the server
+            prefix (str): Path prefix the rule applies to
+            is_opendap (bool): Classification of the matching urls
+        """
+        prefix = prefix.strip("/")
+        with self._lock:
+            self._rules[(host, f"/{prefix}/" if prefix else "/")] = is_opendap
+
+    def seed(self, locations):
+        """Pre-seed rules for known OPeNDAP servers
+
+        Parameters:
+            locations (list): Entries of the form "host" or "host/path/prefix",
+                e.g. "marble-dev01.pcic.uvic.ca/twitcher/ows/proxy/thredds/dodsC"
+        """
+        for location in locations:
+            host, _, prefix = location.strip().partition("/")
+            if host:
+                self.add_rule(host, prefix)
+
+    def clear(self):
+        """Forget every memoized result and rule"""
+        with self._lock:
+            self._results.clear()
+            self._rules.clear()
+
+    def _match_rule(self, url):
+        parsed = urlparse(url)
+        path = parsed.path if parsed.path.endswith("/") else parsed.path + "/"
+        matches = [
+            (len(prefix), is_opendap)
+            for (host, prefix), is_opendap in self._rules.items()
+            if host == parsed.netloc and path.startswith(prefix)
+        ]
+        return max(matches)[1] if matches else None
+
+
+_opendap_probe_cache = None
+
+
+def set_opendap_probe_cache(probe_cache):
+    """Set the process-wide cache used by `is_opendap_url`
+
+    Parameters:
+        probe_cache (OpendapProbeCache): Cache to use, or None to restore the
+            default one
+    """
+    global _opendap_probe_cache
+    _opendap_probe_cache = probe_cache
+
+
+def get_opendap_probe_cache():
+    """Return the process-wide OPeNDAP probe cache
+
+    Unless one was set with `set_opendap_probe_cache`, a cache is created
+    and seeded from the environment variables:
+        WPS_TOOLS_OPENDAP_HOSTS: comma separated "host" or "host/path/prefix"
+            entries known to serve OPeNDAP
+        WPS_TOOLS_OPENDAP_TTL: seconds a classification stays valid
+
+    Returns:
+        OpendapProbeCache: the shared cache
+    """
+    global _opendap_probe_cache
+    if _opendap_probe_cache is None:
+        ttl = os.getenv("WPS_TOOLS_OPENDAP_TTL")
+        _opendap_probe_cache = OpendapProbeCache(ttl=float(ttl) if ttl else 3600)
+        hosts = os.getenv("WPS_TOOLS_OPENDAP_HOSTS")
+        if hosts:
+            _opendap_probe_cache.seed(hosts.split(","))
+    return _opendap_probe_cache
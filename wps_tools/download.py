@@ -0,0 +1,300 @@
+"""Streaming download engine shared by the wps_tools network helpers
+
+Response bodies are written to disk chunk by chunk so that memory use does not
+depend on file size. Transfers over http(s) reuse a pooled `requests.Session`,
+are checked against the Content-Length header and are resumed with a Range
+request when the connection drops. Other schemes (e.g. `file://`) are read with
+`urlopen`.
+"""
+# Processor imports
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ChunkedEncodingError, ConnectionError, Timeout
+
+# Library imports
+import os
+import hashlib
+import threading
+from collections import namedtuple
+from urllib.parse import urlparse
+from urllib.request import urlopen
+
+default_chunk_size = 1024 * 1024
+default_timeout = 60
+
+DownloadResult = namedtuple("DownloadResult", ["size", "digest", "headers"])
+DownloadResult.__doc__ = """Outcome of a download
+
+    Attributes:
+        size (int): Number of bytes written
+        digest (str): Hex digest of the content, if one was requested
+        headers (dict): Headers of the (first) http response, if any
+"""
+
+
+class IncompleteDownloadError(IOError):
+    """Raised when a transfer cannot be completed to its Content-Length"""
+
+
+class ChecksumMismatchError(IOError):
+    """Raised when downloaded content does not match its expected hash"""
+
+    def __init__(self, url, expected, actual):
+        self.url = url
+        self.expected = expected
+        self.actual = actual
+        super().__init__(f"Content of {url} has hash {actual}, expected {expected}")
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Return the pooled `requests.Session` shared by all downloads
+
+    The size of the connection pool per host can be set with the environment
+    variable WPS_TOOLS_HTTP_POOL_SIZE.
+
+    Returns:
+        requests.Session: the shared session
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            pool_size = int(os.getenv("WPS_TOOLS_HTTP_POOL_SIZE", 16))
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            _session = requests.Session()
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+    return _session
+
+
+def open_url(url, headers=None, session=None, timeout=default_timeout):
+    """Send a streaming GET request for url
+
+    Content encoding is disabled so that the body can be checked against
+    Content-Length and resumed by byte offset.
+
+    Parameters:
+        url (str): http(s) url to request
+        headers (dict): Additional request headers
+        session (requests.Session): Session to use, defaults to `get_session()`
+        timeout (float): Connection and read timeout in seconds
+
+    Returns:
+        requests.Response: the response, with its body not yet read
+    """
+    session = session or get_session()
+    headers = {"Accept-Encoding": "identity", **(headers or {})}
+    return session.get(url, headers=headers, stream=True, timeout=timeout)
+
+
+def download(
+    url,
+    file,
+    chunk_size=None,
+    digest=None,
+    expected_digest=None,
+    headers=None,
+    response=None,
+    session=None,
+    max_resumes=3,
+    timeout=default_timeout,
+):
+    """Stream the content of url into an open binary file
+
+    Writing starts at the current position of file. When the server announces
+    the size of the content, the file is preallocated and the transfer is
+    resumed with a Range request if it is interrupted before completion.
+
+    Parameters:
+        url (str): file or http url path to download
+        file (file object): Binary file opened for writing
+        chunk_size (int): Number of bytes read and written at a time
+        digest (str): Name of a hashlib algorithm (e.g. "sha256") used to hash
+            the content while it is written
+        expected_digest (str): Hex digest the content must have, verified
+            without an extra pass over the data. The algorithm defaults to
+            sha256. A mismatch raises ChecksumMismatchError.
+        headers (dict): Additional request headers
+        response (requests.Response): Already opened response for url, e.g. one
+            obtained from a conditional request with `open_url`
+        session (requests.Session): Session to use, defaults to `get_session()`
+        max_resumes (int): Number of times an interrupted transfer is resumed
+        timeout (float): Connection and read timeout in seconds
+
+    Returns:
+        DownloadResult: size, digest and response headers of the download
+    """
+    chunk_size = chunk_size or default_chunk_size
+    if expected_digest and not digest:
+        digest = "sha256"
+
+    start = file.tell()
+    if urlparse(url).scheme not in ("http", "https"):
+        result = _download_local(url, file, chunk_size, digest)
+    else:
+        result = _download_http(
+            url,
+            file,
+            start,
+            chunk_size,
+            digest,
+            headers,
+            response,
+            session,
+            max_resumes,
+            timeout,
+        )
+
+    verify_digest(url, result.digest, expected_digest)
+    return result
+
+
+def verify_digest(url, actual, expected):
+    """Raise ChecksumMismatchError if expected is given and differs from actual
+
+    Parameters:
+        url (str): url the content came from
+        actual (str): hex digest of the content
+        expected (str): expected hex digest, nothing is checked if None
+    """
+    if expected and actual.lower() != expected.lower():
+        raise ChecksumMismatchError(url, expected, actual)
+
+
+def _download_http(
+    url,
+    file,
+    start,
+    chunk_size,
+    digest,
+    headers,
+    response,
+    session,
+    max_resumes,
+    timeout,
+):
+    hasher = hashlib.new(digest) if digest else None
+    written = 0
+    expected = None
+    first_headers = None
+    resumes = 0
+    try:
+        while True:
+            error = None
+            try:
+                if response is None:
+                    range_headers = {"Range": f"bytes={written}-"} if written else {}
+                    response = open_url(
+                        url, {**(headers or {}), **range_headers}, session, timeout
+                    )
+
+                with response:
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        # Full content, either the first request or a server
+                        # ignoring the Range header
+                        file.seek(start)
+                        file.truncate()
+                        hasher = hashlib.new(digest) if digest else None
+                        written = 0
+                        expected = _content_length(response)
+                        first_headers = first_headers or dict(response.headers)
+                        _preallocate(file, expected)
+
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        file.write(chunk)
+                        written += len(chunk)
+                        if hasher:
+                            hasher.update(chunk)
+            except (ChunkedEncodingError, ConnectionError, Timeout) as e:
+                error = e
+            response = None
+
+            if error is not None and first_headers is None:
+                # Nothing received yet, e.g. the host is unreachable
+                raise error
+            elif expected is not None and written > expected:
+                raise IncompleteDownloadError(
+                    f"Received {written} bytes from {url}, expected {expected}"
+                )
+            elif error is None and (expected is None or written == expected):
+                break
+
+            resumes += 1
+            if resumes > max_resumes:
+                raise IncompleteDownloadError(
+                    f"Received {written} of {expected} bytes from {url}"
+                ) from error
+    finally:
+        file.truncate(start + written)
+        file.flush()
+
+    return DownloadResult(
+        written, hasher.hexdigest() if hasher else None, first_headers
+    )
+
+
+def download_to_path(url, path, **kwargs):
+    """Stream the content of url into a new file at path
+
+    Parameters:
+        url (str): file or http url path to download
+        path (str): Path of the file to create
+        **kwargs: Arguments passed on to `download`
+
+    Returns:
+        str: path
+    """
+    with open(path, "wb") as file:
+        download(url, file, **kwargs)
+    return path
+
+
+def file_digest(path, digest="sha256", chunk_size=None):
+    """Hash a local file in chunks
+
+    Parameters:
+        path (str): Path of the file
+        digest (str): Name of a hashlib algorithm
+        chunk_size (int): Number of bytes read at a time
+
+    Returns:
+        str: Hex digest of the file content
+    """
+    hasher = hashlib.new(digest)
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size or default_chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _download_local(url, file, chunk_size, digest):
+    hasher = hashlib.new(digest) if digest else None
+    written = 0
+    with urlopen(url) as source:
+        for chunk in iter(lambda: source.read(chunk_size), b""):
+            file.write(chunk)
+            written += len(chunk)
+            if hasher:
+                hasher.update(chunk)
+    file.flush()
+    return DownloadResult(written, hasher.hexdigest() if hasher else None, None)
+
+
+def _content_length(response):
+    length = response.headers.get("Content-Length")
+    return int(length) if length and length.isdigit() else None
+
+
+def _preallocate(file, length):
+    """Reserve length bytes from the current position of file"""
+    if not length or not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(file.fileno(), file.tell(), length)
+    except (OSError, ValueError):
+        # Unsupported by the file object or filesystem
+        pass
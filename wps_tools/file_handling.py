@@ -1,31 +1,52 @@
 # Processor imports
 from pywps import FORMATS
-from requests import head, get
 from requests.exceptions import ConnectionError, MissingSchema, InvalidSchema
 from pywps.inout.outputs import MetaLink4, MetaFile
 from pywps.app.exceptions import ProcessError
 
 # Tool import
 from nchelpers import CFDataset
+from wps_tools.cache import get_download_cache, get_opendap_probe_cache
+from wps_tools.download import download, download_to_path, file_digest, get_session
+from wps_tools.parallel import map_ordered, url_host
 
 # Library imports
+import io
 import os
+import re
+import csv
+import numpy
+import itertools
+import fnmatch
+import threading
+from collections import namedtuple
 from urllib.parse import urlparse
-from urllib.request import urlretrieve
+from urllib.request import url2pathname
 
+# The netCDF-C library is not thread-safe: files are opened with it one at a
+# time when the helpers run in worker threads
+netcdf_lock = threading.RLock()
 
-def url_handler(workdir, url):
+
+def url_handler(workdir, url, cache=None, sha256=None, filename=None):
     """Handles URL based on its type
 
     A process cannot access to the data from an HTTPServer URL without downloading
     while OPeNDAP URL can be treated as a filepath.
     The function returns the given URL if it is an OPeNDAP path.
     Otherwise, data from the HTTPServer URL are copied to a file created in workdir,
-    and the path to the file is returned.
+    and the path to the file is returned. When a download cache is available, the
+    file in workdir is a link into the cache and the data are only downloaded if
+    the cached copy is missing or stale.
 
     Parameters:
         workdir (str): Path to the workdir
         url (str): URL to be handled
+        cache (wps_tools.cache.DownloadCache): Download cache to use, defaults
+            to the one returned by `get_download_cache`
+        sha256 (str): Expected sha-256 hex digest of the downloaded data
+        filename (str): Name of the file created in workdir, defaults to the
+            last component of url
 
     Returns:
         url/local_file (str): URL/filepath with accessible data
@@ -35,12 +56,16 @@ def url_handler(workdir, url):
         return url
     elif urlparse(url).scheme and urlparse(url).netloc:
         # HTTPServer or other
-        local_file = os.path.join(workdir, url.split("/")[-1])
-        urlretrieve(url, local_file)
+        local_file = os.path.join(workdir, filename or url.split("/")[-1])
+        cache = cache or get_download_cache()
+        if cache and urlparse(url).scheme in ("http", "https"):
+            cache.fetch(url, local_file, sha256)
+        else:
+            download_to_path(url, local_file, expected_digest=sha256)
         return local_file
 
 
-def is_opendap_url(url):  # From Finch bird
+def is_opendap_url(url, probe_cache=None):  # From Finch bird
     """Check if a provided url is an OpenDAP url
 
     The DAP Standard specifies that a specific tag must be included in the
@@ -50,56 +75,258 @@ def is_opendap_url(url):  # From Finch bird
     Even then, some OpenDAP servers seem to not include the specified header...
     So we need to let the netCDF4 library actually open the file.
 
+    Since probing is slow, results are memoized and rules learned per host
+    by an `OpendapProbeCache`. Failed connections are not memoized.
+
     Parameters:
         url (str): Provided url
+        probe_cache (wps_tools.cache.OpendapProbeCache): Cache to use, defaults
+            to the one returned by `get_opendap_probe_cache`
 
     Returns:
         bool: True if url is OpenDAP, False otherwise
     """
+    probe_cache = probe_cache or get_opendap_probe_cache()
+    known = probe_cache.lookup(url)
+    if known is not None:
+        return known
+
     try:
-        content_description = head(url, timeout=5).headers.get("Content-Description")
+        response = get_session().head(url, timeout=5)
+        content_description = response.headers.get("Content-Description")
     except (ConnectionError, MissingSchema, InvalidSchema):
         return False
 
     if content_description:
-        return content_description.lower().startswith("dods")
+        is_opendap = content_description.lower().startswith("dods")
     else:
         try:
-            dataset = CFDataset(url)
+            with netcdf_lock:
+                dataset = CFDataset(url)
         except OSError:
             return False
-        return dataset.disk_format in ("DAP2", "DAP4")
+        is_opendap = dataset.disk_format in ("DAP2", "DAP4")
+
+    probe_cache.store(url, is_opendap)
+    return is_opendap
+
+
+netcdf_signatures = (
+    b"CDF\x01",  # netCDF3 classic
+    b"CDF\x02",  # netCDF3 64-bit offset
+    b"CDF\x05",  # netCDF3 64-bit data (CDF5)
+    b"\x89HDF\r\n\x1a\n",  # netCDF4 (HDF5)
+)
+
+NCInputCheck = namedtuple("NCInputCheck", ["kind", "path"])
+NCInputCheck.__doc__ = """Outcome of the validation of a netCDF input
+
+    Attributes:
+        kind (str): "opendap", "local-netcdf" or "rejected"
+        path (str): OPeNDAP url or local file path of the input
+"""
+
+
+def sniff_netcdf(path):
+    """Check whether a local file is netCDF from its first bytes
+
+    Parameters:
+        path (str): Local file path or file url
+
+    Returns:
+        bool: True if the file starts with a netCDF3 or HDF5 signature,
+            False otherwise and None if the file cannot be read
+    """
+    if path.startswith("file:"):
+        path = url2pathname(urlparse(path).path)
+    try:
+        with open(path, "rb") as file:
+            header = file.read(8)
+    except OSError:
+        return None
+    return header.startswith(netcdf_signatures)
+
+
+def _check_local_input(path):
+    file_path = path.file
+    is_netcdf = sniff_netcdf(file_path)
+    if is_netcdf is None:
+        # Unreadable here, e.g. only accessible to the backend
+        is_netcdf = file_path.endswith(".nc")
+    return NCInputCheck("local-netcdf" if is_netcdf else "rejected", file_path)
+
+
+def _is_remote(url):
+    return urlparse(url).scheme in ("http", "https") and urlparse(url).netloc
+
+
+def validate_nc_inputs(nc_input, max_workers=8, host_limit=None):
+    """Classify netcdf inputs as OPeNDAP urls, local netCDF files or rejected
+
+    Inputs without an http(s) url are local and checked without any request
+    by reading the first bytes of their file. Remote inputs are probed with
+    `is_opendap_url` concurrently; those that are not OPeNDAP are checked
+    like local inputs once downloaded.
+
+    Parameters:
+        nc_input (pywps.ComplexInput): Object containing local or OpenDAP file paths
+        max_workers (int): Number of remote inputs probed concurrently
+        host_limit (int): Maximum number of concurrent probes per host
+
+    Returns:
+        list: NCInputCheck for each input, in order
+    """
+    nc_input = list(nc_input)
+    remote = [path for path in nc_input if _is_remote(path.url or "")]
+    opendap = dict(
+        zip(
+            map(id, remote),
+            map_ordered(
+                lambda path: is_opendap_url(path.url),
+                remote,
+                max_workers,
+                group_limit=host_limit,
+                group=lambda path: url_host(path.url),
+            ),
+        )
+    )
+
+    return [
+        NCInputCheck("opendap", path.url)
+        if opendap.get(id(path))
+        else _check_local_input(path)
+        for path in nc_input
+    ]
 
 
-def get_filepaths(nc_input):
+def get_filepaths(nc_input, max_workers=8, host_limit=None):
     """Collect list of netcdf file paths
 
     Each path in nc_input is checked to determine if it is an OpenDAP url. If so,
     then the url is appended to the path list. If not, then whether or not it's a valid
     netcdf file is checked. If so, then the path is appended to the list. If not, then
-    a ProcessError is raised due to an invalid input.
+    a ProcessError is raised due to an invalid input. See `validate_nc_inputs`.
 
     Parameters:
         nc_input (pywps.ComplexInput): Object containing local or OpenDAP file paths
+        max_workers (int): Number of remote inputs probed concurrently
+        host_limit (int): Maximum number of concurrent probes per host
 
     Returns:
         list: List of filepaths
     """
-    filepaths = []
-    for path in nc_input:
-        if is_opendap_url(path.url):
-            filepaths.append(path.url)
-        elif path.file.endswith(".nc"):
-            filepaths.append(path.file)
-        else:
-            raise ProcessError(
-                "You must provide a data source (opendap/netcdf). "
-                f"Inputs provided: {nc_input}"
-            )
-    return filepaths
+    checks = validate_nc_inputs(nc_input, max_workers, host_limit)
+    if any(check.kind == "rejected" for check in checks):
+        raise ProcessError(
+            "You must provide a data source (opendap/netcdf). "
+            f"Inputs provided: {nc_input}"
+        )
+    return [check.path for check in checks]
+
+
+_TIME_CHUNK = re.compile(r"(?<!\d)(\d{4,8})-(\d{4,8})(?!\d)")
+
+
+def _output_matcher(varname, match):
+    """Return a function telling whether a file name matches varname"""
+    if isinstance(varname, re.Pattern) or match == "regex":
+        pattern = re.compile(varname)
+        return lambda name: pattern.search(name) is not None
+    elif match == "substring":
+        return lambda name: varname in name
+    elif match == "token":
+        # varname delimited by non alphanumeric characters, e.g. "_" or "."
+        pattern = re.compile(rf"(?<![A-Za-z0-9]){re.escape(varname)}(?![A-Za-z0-9])")
+        return lambda name: pattern.search(name) is not None
+    elif match == "glob":
+        return lambda name: fnmatch.fnmatchcase(name, varname)
+    else:
+        raise ValueError(
+            f'Invalid match argument "{match}": must be one of '
+            '"substring", "token", "glob" or "regex"'
+        )
+
+
+def _time_chunk_key(path):
+    """Sort key ordering files by the first date of their time range
+
+    Dates such as 1951 and 19510101 are compared on the same scale. Files
+    without a time range come last.
+    """
+    name = os.path.basename(path)
+    chunks = _TIME_CHUNK.findall(name)
+    if not chunks:
+        return (1, "", path)
+    return (0, chunks[-1][0].ljust(8, "0"), path)
+
+
+def _scan_files(outdir, recursive):
+    """Paths relative to outdir of the files it contains"""
+    pending = [""]
+    while pending:
+        subdir = pending.pop()
+        with os.scandir(os.path.join(outdir, subdir)) as entries:
+            for entry in entries:
+                relpath = os.path.join(subdir, entry.name)
+                if entry.is_dir():
+                    if recursive:
+                        pending.append(relpath)
+                else:
+                    yield relpath
+
+
+class OutputIndex:
+    """In-memory record of the output files written to a directory
+
+    Processes register each file as they write it, and `collect_output_files`
+    then looks the files up in the index instead of scanning the directory.
+
+    Parameters:
+        outdir (str): Directory containing the output files
+    """
+
+    def __init__(self, outdir):
+        self.outdir = outdir
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def register(self, path):
+        """Record an output file
+
+        Parameters:
+            path (str): Path of the file, absolute or relative to outdir
+        """
+        relpath = os.path.relpath(os.path.join(self.outdir, path), self.outdir)
+        with self._lock:
+            self._files[relpath] = None
 
+    def unregister(self, path):
+        """Forget an output file, e.g. after removing it"""
+        relpath = os.path.relpath(os.path.join(self.outdir, path), self.outdir)
+        with self._lock:
+            self._files.pop(relpath, None)
 
-def collect_output_files(varname, outdir=os.getcwd()):
+    def files(self):
+        """Paths relative to outdir of the registered files, in order"""
+        with self._lock:
+            return list(self._files)
+
+    def __contains__(self, path):
+        relpath = os.path.relpath(os.path.join(self.outdir, path), self.outdir)
+        return relpath in self._files
+
+    def __len__(self):
+        return len(self._files)
+
+
+def collect_output_files(
+    varname,
+    outdir=os.getcwd(),
+    match="substring",
+    recursive=False,
+    sort=None,
+    index=None,
+):
     """Collect output netcdf files
 
     The given directory is searched for the files that contain
@@ -107,14 +334,71 @@ def collect_output_files(varname, outdir=os.getcwd()):
     by the same process. Though the default directory is the current directory,
     it is most often the current WPS process's working directory.
 
+    Since a plain substring test also matches other variables (e.g. "pr"
+    matches "prsn"), varname can be matched as a token delimited by
+    non alphanumeric characters, as a glob pattern or as a regular
+    expression.
+
     Parameters:
-        varname (str): Name of variable (must be in file names)
+        varname (str or re.Pattern): Name of variable (must be in file names).
+            A compiled pattern is always matched as a regular expression.
         outdir (str): Directory containing output files
+        match (str): How file names are matched against varname, one of
+            "substring", "token", "glob" or "regex"
+        recursive (bool): Whether to search the subdirectories of outdir,
+            whose files are returned as paths relative to outdir
+        sort (str): Order of the files: None (directory order), "name" or
+            "time", by the first date of time ranges such as 19500101-19591231
+        index (OutputIndex): Index of outdir to search instead of the
+            filesystem
 
     Returns:
         list: List of output files
     """
-    return [file for file in os.listdir(outdir) if varname in file]
+    if sort not in (None, "name", "time"):
+        raise ValueError(
+            f'Invalid sort argument "{sort}": must be None, "name" or "time"'
+        )
+
+    matches = _output_matcher(varname, match)
+    if index is not None:
+        candidates = [file for file in index.files() if recursive or os.sep not in file]
+    else:
+        candidates = _scan_files(outdir, recursive)
+
+    files = [file for file in candidates if matches(os.path.basename(file))]
+
+    if sort == "name":
+        files.sort()
+    elif sort == "time":
+        files.sort(key=_time_chunk_key)
+    return files
+
+
+class _HashedMetaFile(MetaFile):
+    """MetaFile whose sha-256 hash is known, so pywps does not read the file"""
+
+    def __init__(self, identity=None, description=None, fmt=None, sha256=None):
+        super().__init__(identity, description, fmt=fmt)
+        self._sha256 = sha256
+
+    @property
+    def hash(self):
+        if self._sha256 is None:
+            self._sha256 = super().hash
+        return self._sha256
+
+
+def output_file_metadata(path):
+    """Size and sha-256 hash of an output file, as used by `build_meta_link`
+
+    Parameters:
+        path (str): Path of the file
+
+    Returns:
+        dict: "size" (int) and "sha256" (str) of the file
+    """
+    return {"size": os.path.getsize(path), "sha256": file_digest(path)}
 
 
 def build_meta_link(
@@ -124,12 +408,21 @@ def build_meta_link(
     format_name="netCDF",
     fmt=FORMATS.NETCDF,
     outdir=os.getcwd(),
+    checksums=None,
+    metadata=None,
+    max_workers=None,
 ):
     """Create meta link between output files
 
     A MetaLink4 object is created to contain a description of the
     process output, and a MetaFile is created for each output file to be
-    appended to this link.
+    appended to this link. With checksums, the sha-256 hash of each file is
+    included so that clients can verify their downloads.
+
+    Processes that know the size and hash of their outputs (e.g. hashed while
+    writing them) can pass them in metadata so that the files are not read
+    again. Missing hashes are computed in one pass over the files by a pool
+    of threads.
 
     Parameters:
         varname (str): Name of variable (used for MetaLink4)
@@ -138,41 +431,75 @@ def build_meta_link(
         format_name (str): Format name of output files
         fmt (pywps.FORMATS): Format of output files
         outdir (str): Directory containing output files
+        checksums (bool): Whether to include the sha-256 hash of each file.
+            By default, hashes are included if metadata has one for every file.
+        metadata (dict): Precomputed "size" and/or "sha256" of output files,
+            by file name (see `output_file_metadata`)
+        max_workers (int): Number of files hashed concurrently, defaults to
+            the number of CPUs
 
     Returns:
         MetaLink4.xml: xml of metalink connecting output files
     """
+    metadata = metadata or {}
+    if checksums is None:
+        checksums = bool(outfiles) and all(
+            metadata.get(file, {}).get("sha256") for file in outfiles
+        )
+
+    hashes = {file: metadata.get(file, {}).get("sha256") for file in outfiles}
+    if checksums:
+        missing = [file for file, sha256 in hashes.items() if not sha256]
+        computed = map_ordered(
+            lambda file: file_digest(os.path.join(outdir, file)),
+            missing,
+            max_workers or os.cpu_count(),
+        )
+        hashes.update(zip(missing, computed))
+
     if len(outfiles) == 1:
         meta_link = MetaLink4(
-            "output", f"Output of {format_name} {varname} file", workdir=outdir
+            "output",
+            f"Output of {format_name} {varname} file",
+            workdir=outdir,
+            checksums=checksums,
         )
     else:
         meta_link = MetaLink4(
-            "output", f"Output of {format_name} {varname} files", workdir=outdir
+            "output",
+            f"Output of {format_name} {varname} files",
+            workdir=outdir,
+            checksums=checksums,
         )
 
     for file in outfiles:
         # Create a MetaFile instance, which instantiates a ComplexOutput object.
-        meta_file = MetaFile(f"{file}", desc, fmt=fmt)
+        meta_file = _HashedMetaFile(f"{file}", desc, fmt=fmt, sha256=hashes[file])
         meta_file.file = os.path.join(outdir, file)
+        size = metadata.get(file, {}).get("size")
+        meta_file.size = size if size is not None else os.path.getsize(meta_file.file)
         meta_link.append(meta_file)
 
     return meta_link.xml
 
 
-def copy_http_content(http, file):
+def copy_http_content(http, file, chunk_size=None, sha256=None):
     """
     This function is implemented to copy the content of a file passed
-    as an http address to a local file.
+    as an http address to a local file. The content is streamed in chunks
+    rather than read into memory.
 
     Parameters:
         http (str): http address containing the desired content
         file (file object): path to the
             file that the content will be copied to
+        chunk_size (int): Number of bytes copied at a time
+        sha256 (str): Expected sha-256 hex digest of the content, checked
+            while it is copied
     Returns:
         Path to the copied file in /tmp directory
     """
-    file.write(get(http).content)
+    download(http, file, chunk_size=chunk_size, expected_digest=sha256)
     return file.name
 
 
@@ -181,3 +508,160 @@ def csv_handler(file_):
         csv_content = csv_file.read()
 
     return csv_content
+
+
+def _csv_text(source, encoding):
+    """Text stream of a path, a pywps input or a text or binary stream
+
+    Returns the stream and a function releasing it: files opened here are
+    closed, while streams of the caller are left open.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        text = open(source, "r", encoding=encoding, newline="")
+        return text, text.close
+
+    # The stream property of pywps inputs opens a new file on each access
+    stream = getattr(source, "stream", source)
+    if isinstance(stream, io.TextIOBase):
+        return stream, lambda: None
+    if isinstance(stream, io.RawIOBase):
+        stream = io.BufferedReader(stream)
+    text = io.TextIOWrapper(stream, encoding=encoding, newline="")
+    return text, text.detach
+
+
+_zero_padded = re.compile(r"\s*[+-]?0\d")
+
+
+def _infer_csv_type(values):
+    """Narrowest of int, float and str that every non-empty value parses as
+
+    Columns with zero-padded numbers (e.g. station ids like "0012") are
+    kept as str so that no leading zero is lost.
+    """
+    values = list(values)
+    if any(_zero_padded.match(value) for value in values):
+        return str
+    for type_ in (int, float):
+        try:
+            for value in values:
+                if value != "":
+                    type_(value)
+        except ValueError:
+            continue
+        return type_
+    return str
+
+
+def _csv_column_array(values, type_):
+    if type_ is float:
+        return numpy.array(values, dtype=numpy.float64)
+    elif type_ is int and None not in values:
+        return numpy.array(values, dtype=numpy.int64)
+    elif type_ is str and None not in values:
+        return numpy.array(values, dtype=str)
+    return numpy.array(values, dtype=object)
+
+
+def iter_csv_batches(
+    source,
+    batch_size=10000,
+    delimiter=None,
+    header=True,
+    infer_types=False,
+    columns=False,
+    encoding="utf-8",
+):
+    """Read a CSV file in batches of rows without loading all of it
+
+    Unlike `csv_handler`, only one batch of rows is held in memory at a time,
+    so rows can be processed as soon as they are read. The first line holds
+    the column names unless header is False, in which case columns are
+    numbered from 0.
+
+    With infer_types, the type of each column (int, float or str) is inferred
+    from the first batch and applied to every batch; empty fields of numeric
+    columns become None (NaN in float column arrays). Columns holding
+    zero-padded numbers stay str. A value that does not parse as its
+    column's type raises a ValueError, as does a row with more fields than
+    there are columns.
+
+    Parameters:
+        source (str, stream or pywps.ComplexInput): Path of the file, text or
+            binary stream (e.g. the `.stream` of a csv input) or input whose
+            stream is read
+        batch_size (int): Maximum number of rows per batch
+        delimiter (str): Field delimiter, detected from the first lines if None
+        header (bool): Whether the first line holds the column names
+        infer_types (bool): Whether to convert fields to inferred types
+        columns (bool): Whether to yield column arrays instead of rows
+        encoding (str): Encoding of binary streams and files
+
+    Yields:
+        list of dict: rows of the batch, by column name, or
+        dict of numpy.ndarray: the columns of the batch if columns is True
+    """
+    text, release = _csv_text(source, encoding)
+    try:
+        sample = text.read(64 * 1024)
+        if sample and not sample.endswith("\n"):
+            # Complete the last line so that it is parsed in one piece
+            sample += text.readline()
+
+        dialect = csv.excel
+        if delimiter is None:
+            try:
+                dialect = csv.Sniffer().sniff(sample, delimiters=",;\t|")
+            except csv.Error:
+                pass
+        reader = csv.reader(
+            itertools.chain(io.StringIO(sample, newline=""), text),
+            dialect,
+            **({"delimiter": delimiter} if delimiter else {}),
+        )
+        # Skip blank lines
+        reader = (row for row in reader if row)
+
+        names = next(reader, None) if header else None
+        types = None
+        row_count = 0
+        while True:
+            rows = list(itertools.islice(reader, batch_size))
+            if not rows:
+                break
+
+            if names is None:
+                names = list(range(len(rows[0])))
+            for number, row in enumerate(rows, start=row_count + 1):
+                if len(row) > len(names):
+                    raise ValueError(
+                        f"Row {number} has {len(row)} fields, more than the "
+                        f"{len(names)} columns"
+                    )
+            row_count += len(rows)
+            if infer_types and types is None:
+                types = [
+                    _infer_csv_type(row[index] for row in rows if index < len(row))
+                    for index in range(len(names))
+                ]
+            if types:
+                rows = [
+                    [
+                        type_(value) if value != "" or type_ is str else None
+                        for value, type_ in zip(row, types)
+                    ]
+                    for row in rows
+                ]
+
+            if columns:
+                yield {
+                    name: _csv_column_array(
+                        [row[index] if index < len(row) else None for row in rows],
+                        types[index] if types else str,
+                    )
+                    for index, name in enumerate(names)
+                }
+            else:
+                yield [dict(zip(names, row)) for row in rows]
+    finally:
+        release()
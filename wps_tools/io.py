@@ -3,6 +3,7 @@ import os
 import logging
 from pywps.app.exceptions import ProcessError
 from wps_tools.file_handling import url_handler
+from wps_tools.parallel import map_ordered
 
 
 # Inputs
@@ -103,7 +104,27 @@ def process_inputs_alpha(request_inputs, expected_inputs, workdir):
     return [value for name, value in sorted(collected.items())]
 
 
-def collect_args(inputs, workdir):
+def _local_filenames(urls):
+    """Distinct names of the files fetched from urls, keeping their extensions
+
+    The first url ending with a given name keeps it, the next ones get a
+    numbered suffix, e.g. "tasmax_1.nc".
+    """
+    filenames = {}
+    used = set()
+    for url in urls:
+        filename = url.split("/")[-1]
+        root, ext = os.path.splitext(filename)
+        count = 0
+        while filename in used:
+            count += 1
+            filename = f"{root}_{count}{ext}"
+        used.add(filename)
+        filenames[url] = filename
+    return filenames
+
+
+def collect_args(inputs, workdir, cache=None, max_workers=None, host_limit=None):
     """Collects PyWPS input arguments
 
     There are 4 ways to retrieve PyWPS input arguments depending on their types:
@@ -115,9 +136,20 @@ def collect_args(inputs, workdir):
         - `.file` is used to retrieve the filepath
         - `.stream` is used to retrieve the csv datastreams
 
+    Remote ComplexInputs are fetched one after another unless max_workers is
+    given, in which case every remote input across all identifiers is fetched
+    concurrently before the inputs are collected. The first failing fetch
+    cancels the remaining ones and its error is raised. Each url is fetched
+    once, and distinct urls ending with the same file name are stored under
+    distinct names in workdir.
+
     Parameters:
         inputs (dict): Collection of inputs provided by PyWPS
         workdir (str): Path to the workdir
+        cache (wps_tools.cache.DownloadCache): Download cache for remote inputs,
+            defaults to the one returned by `get_download_cache`
+        max_workers (int): Number of remote inputs fetched concurrently
+        host_limit (int): Maximum number of concurrent fetches per host
 
     Returns:
         Dict containing processed inputs
@@ -127,15 +159,29 @@ def collect_args(inputs, workdir):
         """Handler for LiteralInputs"""
         return input.data
 
+    def remote_url(input):
+        """URL of a ComplexInput that has to be fetched, if any"""
+        if "csv" in vars(input)["identifier"]:
+            return None
+
+        # Check for a remote URL: try the new 'url' attribute, falling back to the legacy '_url'
+        return getattr(input, "url", None) or getattr(input, "_url", None)
+
+    def fetch(url):
+        return url_handler(workdir, url, cache, filename=filenames[url])
+
     def process_complex(input):
         """Handler for ComplexInputs"""
         if "csv" in vars(input)["identifier"]:
             return input.stream
 
-        # Check for a remote URL: try the new 'url' attribute, falling back to the legacy '_url'
-        url_val = getattr(input, "url", None) or getattr(input, "_url", None)
-        if url_val is not None:
-            return url_handler(workdir, url_val)
+        url_val = remote_url(input)
+        if url_val in fetched:
+            return fetched[url_val]
+
+        elif url_val is not None:
+            fetched[url_val] = fetch(url_val)
+            return fetched[url_val]
 
         elif os.path.isfile(input.file):
             return input.file
@@ -161,4 +207,17 @@ def collect_args(inputs, workdir):
             (input,) = multi_input
             return processor(input)
 
+    urls = []
+    for multi_input in inputs.values():
+        if multi_input[0].json["type"] == "complex":
+            urls.extend(remote_url(input) for input in multi_input)
+    urls = list(dict.fromkeys(url for url in urls if url is not None))
+    filenames = _local_filenames(urls)
+
+    fetched = {}
+    if max_workers:
+        fetched = dict(
+            zip(urls, map_ordered(fetch, urls, max_workers, group_limit=host_limit))
+        )
+
     return {identifier: process_input(input) for identifier, input in inputs.items()}
@@ -1,4 +1,15 @@
+import os
+import sys
+import json
+import time
+import atexit
 import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from weakref import WeakKeyDictionary
+from queue import SimpleQueue
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
 
 common_status_percentages = {
@@ -9,6 +20,322 @@ common_status_percentages = {
 }
 
 
+class _BufferedFileHandler(logging.Handler):
+    """Handler appending messages to a buffered file
+
+    The buffer is flushed when a record reaches flush_level or when
+    flush_interval seconds have passed since the last flush.
+    """
+
+    def __init__(self, path, flush_level, flush_interval):
+        super().__init__()
+        self.stream = open(path, "a", encoding="utf8")
+        self.flush_level = flush_level
+        self.flush_interval = flush_interval
+        self._last_flush = time.monotonic()
+
+    def emit(self, record):
+        if self.stream.closed:
+            return
+        self.stream.write(record.getMessage() + "\n")
+        if (
+            record.levelno >= self.flush_level
+            or time.monotonic() - self._last_flush >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        self.acquire()
+        try:
+            if not self.stream.closed:
+                self.stream.flush()
+            self._last_flush = time.monotonic()
+        finally:
+            self.release()
+
+    def close(self):
+        self.acquire()
+        try:
+            if not self.stream.closed:
+                self.stream.flush()
+                self.stream.close()
+        finally:
+            self.release()
+        super().close()
+
+
+class LogSink:
+    """Buffered writer for the log file of a process
+
+    A single handle is kept open for the file instead of opening it for
+    every message. Messages are written through a buffer that is flushed when
+    a message reaches flush_level, when flush_interval seconds have passed
+    since the last flush, and when the sink is closed.
+
+    In background mode, messages are handed to a `QueueListener` thread
+    through a `QueueHandler`, so that callers never wait on the disk.
+
+    Parameters:
+        path (str): Path of the log file, opened in append mode
+        flush_level (int): Logging level of messages flushed immediately
+        flush_interval (float): Maximum time in seconds between flushes, as
+            checked when a message is written
+        background (bool): Whether to write from a background thread
+    """
+
+    def __init__(
+        self, path, flush_level=logging.WARNING, flush_interval=1.0, background=False
+    ):
+        self.path = path
+        self._handler = _BufferedFileHandler(path, flush_level, flush_interval)
+        if background:
+            queue = SimpleQueue()
+            self._front = QueueHandler(queue)
+            self._listener = QueueListener(queue, self._handler)
+            self._listener.start()
+        else:
+            self._front = self._handler
+            self._listener = None
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def write(self, message, level=logging.INFO):
+        """Write a message as a line of the log file
+
+        Parameters:
+            message (str): Message to write
+            level (int): Logging level of the message
+        """
+        if self.closed:
+            raise ValueError(f"Log sink for {self.path} is closed")
+        record = logging.makeLogRecord({"msg": message, "levelno": level})
+        self._front.handle(record)
+
+    def flush(self):
+        """Write the buffered messages to the file
+
+        In background mode, messages still queued are not waited for.
+        """
+        self._handler.flush()
+
+    def close(self):
+        """Write every pending message and close the file"""
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+        if self._listener:
+            self._listener.stop()
+            self._front.close()
+        self._handler.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_sinks = {}
+_sinks_lock = threading.Lock()
+
+
+def get_log_sink(path, **kwargs):
+    """Return the open log sink of a file, creating it if needed
+
+    Parameters:
+        path (str): Path of the log file
+        **kwargs: Arguments passed on to `LogSink` when it is created
+
+    Returns:
+        LogSink: the sink writing to path
+    """
+    key = os.path.abspath(path)
+    with _sinks_lock:
+        sink = _sinks.get(key)
+        if sink is None or sink.closed:
+            sink = _sinks[key] = LogSink(key, **kwargs)
+    return sink
+
+
+def close_log_sinks(workdir=None):
+    """Close the open log sinks, e.g. when a process is done
+
+    Parameters:
+        workdir (str): Only close the sinks of files in this directory
+    """
+    with _sinks_lock:
+        if workdir is None:
+            keys = list(_sinks)
+        else:
+            prefix = os.path.join(os.path.abspath(workdir), "")
+            keys = [key for key in _sinks if key.startswith(prefix)]
+        sinks = [_sinks.pop(key) for key in keys]
+
+    for sink in sinks:
+        sink.close()
+
+
+atexit.register(close_log_sinks)
+
+
+@contextmanager
+def closing_log_sinks(workdir):
+    """Close the log sinks of a workdir when the block exits
+
+    The sinks are otherwise closed at the "complete" step of `log_handler`,
+    which a failing process never reaches. Wrapping the body of a process
+    handler in this block closes them however it exits.
+
+    Parameters:
+        workdir (str): Working directory of the process
+    """
+    try:
+        yield
+    finally:
+        close_log_sinks(workdir)
+
+
+class StatusThrottle:
+    """Coalesces the status updates of a response
+
+    Updating the status of a pywps response rewrites the status document, so
+    updates sent for every message of a loop can dominate the run time. An
+    update is let through if it is the first, if its level is WARNING or
+    above, if it is one of the steps of `common_status_percentages`, if the
+    status percentage changed by at least min_percentage_change, or if
+    1 / max_per_second seconds have passed since the previous update.
+
+    Parameters:
+        max_per_second (float): Maximum rate of other updates
+        min_percentage_change (float): Change of status percentage that is
+            always reported
+
+    Attributes:
+        suppressed (int): Number of updates that were not sent
+    """
+
+    def __init__(self, max_per_second=1.0, min_percentage_change=1):
+        self.max_per_second = max_per_second
+        self.min_percentage_change = min_percentage_change
+        self.suppressed = 0
+        self._last_time = None
+        self._last_percentage = None
+        self._lock = threading.Lock()
+
+    def allow(self, status_percentage, level=logging.INFO, process_step=None):
+        """Return whether an update should be sent, recording it if so
+
+        Parameters:
+            status_percentage (int): Status percentage of the update
+            level (int): Logging level of the message
+            process_step (str): Process step of the update, if any
+
+        Returns:
+            bool: True if the update should be sent
+        """
+        now = time.monotonic()
+        with self._lock:
+            if (
+                self._last_time is None
+                or level >= logging.WARNING
+                or process_step in common_status_percentages
+                or abs(status_percentage - self._last_percentage)
+                >= self.min_percentage_change
+                or now - self._last_time >= 1 / self.max_per_second
+            ):
+                self._last_time = now
+                self._last_percentage = status_percentage
+                return True
+
+            self.suppressed += 1
+            return False
+
+
+_throttles = WeakKeyDictionary()
+_throttles_lock = threading.Lock()
+
+
+def get_status_throttle(response, **kwargs):
+    """Return the status throttle of a response, creating it if needed
+
+    Parameters:
+        response (pywps.WPSResponse): Response object for process
+        **kwargs: Arguments passed on to `StatusThrottle` when it is created
+
+    Returns:
+        StatusThrottle: the throttle of response
+    """
+    with _throttles_lock:
+        throttle = _throttles.get(response)
+        if throttle is None:
+            throttle = _throttles[response] = StatusThrottle(**kwargs)
+    return throttle
+
+
+_step_times = WeakKeyDictionary()
+_step_times_lock = threading.Lock()
+
+
+def peak_rss():
+    """Peak resident set size of the current process, in bytes
+
+    Returns:
+        int: the peak RSS, or None where the resource module is unavailable
+            (e.g. on Windows)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes on Linux and in bytes on macOS
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def structured_record(process, message, log_level="INFO", process_step=None, **fields):
+    """Format a message as a JSON line for structured logs
+
+    The record holds a UTC timestamp, the identifier and UUID of the process,
+    the level, the process step, the time in seconds since the previous step
+    of the same process (for step records), the peak RSS of the Python
+    process and the message, plus any additional fields.
+
+    Parameters:
+        process (pywps.Process): Currently running WPS process
+        message (str): Message of the record
+        log_level (str): Logging level of the message
+        process_step (str): Current stage of process execution
+        **fields: Additional JSON serializable fields
+
+    Returns:
+        str: the record, as a single line of JSON
+    """
+    now = time.monotonic()
+    elapsed = None
+    if process_step:
+        with _step_times_lock:
+            previous = _step_times.get(process)
+            _step_times[process] = now
+        if previous is not None:
+            elapsed = round(now - previous, 6)
+
+    uuid = getattr(process, "uuid", None)
+    record = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "process": process.identifier,
+        "uuid": str(uuid) if uuid is not None else None,
+        "level": log_level,
+        "step": process_step,
+        "elapsed": elapsed,
+        "peak_rss": peak_rss(),
+        "message": message,
+        **fields,
+    }
+    return json.dumps(record)
+
+
 def log_handler(
     process,
     response,
@@ -17,12 +344,19 @@ def log_handler(
     log_level="INFO",
     process_step=None,
     log_file_name="log.txt",
+    throttle=True,
+    structured=False,
 ):
     """Output message to logger and update response status
 
     A message is outputted to a logger and log file at the specified level, and
     the progress status of the response is updated according to the specified
     process step. The log file is stored in the process's working directory.
+    It is written through a buffered `LogSink`, which is closed at the
+    "complete" step, or by `closing_log_sinks` if the process fails before
+    reaching it. Every message is logged, but status updates are
+    coalesced by the `StatusThrottle` of the response. In structured mode,
+    the log file receives JSON lines made by `structured_record`.
 
     Parameters:
         process (pywps.Process): Currently running WPS process
@@ -32,14 +366,90 @@ def log_handler(
         log_level (str): Logging level at which to output message
         process_step (str): Current stage of process execution
         log_file_name (str): File to store logger content
+        throttle (bool): Whether to throttle status updates
+        structured (bool): Whether to write JSON lines to the log file
     """
+    # Log to all sources
+    level = getattr(logging, log_level)
+    logger.log(level, message)
+    log_file_path = Path(process.workdir) / log_file_name  # From Finch bird
+    sink = get_log_sink(log_file_path)
+    if structured:
+        sink.write(structured_record(process, message, log_level, process_step), level)
+    else:
+        sink.write(message, level)
+    if process_step == "complete":
+        with _sinks_lock:
+            _sinks.pop(sink.path, None)
+        sink.close()
+
+    _update_status(process, response, message, level, process_step, throttle)
+
+
+def _update_status(process, response, message, level, process_step, throttle):
     if process_step:
         status_percentage = process.status_percentage_steps[process_step]
     else:
         status_percentage = response.status_percentage
 
-    # Log to all sources
-    logger.log(getattr(logging, log_level), message)
-    log_file_path = Path(process.workdir) / log_file_name  # From Finch bird
-    log_file_path.open("a", encoding="utf8").write(message + "\n")
-    response.update_status(message, status_percentage=status_percentage)
+    if not throttle or get_status_throttle(response).allow(
+        status_percentage, level, process_step
+    ):
+        response.update_status(message, status_percentage=status_percentage)
+
+
+@contextmanager
+def log_span(
+    process,
+    response,
+    step,
+    logger,
+    message=None,
+    log_level="INFO",
+    log_file_name="log.txt",
+):
+    """Time a block of a process as a step of structured logs
+
+    Entering the block writes a structured record of the step, with the time
+    elapsed since the previous step, and updates the status like `log_handler`
+    if step is one of the process's status steps. Leaving it writes a "span"
+    record with its duration in seconds and whether it raised an exception.
+
+    Parameters:
+        process (pywps.Process): Currently running WPS process
+        response (pywps.WPSResponse): Response object for process
+        step (str): Name of the step
+        logger (logging.Logger): Logger to store messages
+        message (str): Message logged when entering the block
+        log_level (str): Logging level of the records
+        log_file_name (str): File to store logger content
+    """
+    process_step = step if step in process.status_percentage_steps else None
+    message = message or f"Starting {step}"
+    level = getattr(logging, log_level)
+    logger.log(level, message)
+    sink = get_log_sink(Path(process.workdir) / log_file_name)
+    sink.write(structured_record(process, message, log_level, step), level)
+    _update_status(process, response, message, level, process_step, True)
+
+    start = time.monotonic()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        duration = round(time.monotonic() - start, 6)
+        end_message = f"Finished {step} in {duration:.3f}s ({outcome})"
+        logger.debug(end_message)
+        record = structured_record(
+            process,
+            end_message,
+            log_level,
+            span=step,
+            duration=duration,
+            outcome=outcome,
+        )
+        sink = get_log_sink(Path(process.workdir) / log_file_name)
+        sink.write(record, level)
+        if process_step == "complete":
+            close_log_sinks(process.workdir)
@@ -1,116 +1,525 @@
-import json, requests, math
+import json, math, hashlib, codecs, functools
 
 from netCDF4 import Dataset
 from tempfile import NamedTemporaryFile
-from bs4 import BeautifulSoup
-from urllib.request import urlopen, urlretrieve
+from xml.etree import ElementTree
+from urllib.parse import urlparse
+from urllib.request import urlopen, url2pathname
 
-from wps_tools.file_handling import copy_http_content
+from wps_tools.cache import get_download_cache
+from wps_tools.file_handling import copy_http_content, is_opendap_url, netcdf_lock
+from wps_tools.download import download, open_url, verify_digest
+from wps_tools.parallel import imap_ordered
 
 
-def nc_to_dataset(url):
+def nc_to_dataset(url, lazy=False, sha256=None):
     """
     Access content of a netcdf file from an http url as a Dataset object
     using the netCDF4 library.
 
+    By default the whole file is copied to a temporary file. In lazy mode,
+    local files and OPeNDAP urls are opened in place and http urls are
+    opened with netCDF4's byte-range support when the server and library
+    allow it, so that only the variables and slices read are transferred.
+    Otherwise the file is streamed to a temporary file that is removed from
+    the filesystem as soon as the dataset has opened it, so it lives exactly
+    as long as the returned dataset.
+
+    When the sha-256 hash of the file is known, the copy is verified while it
+    is written, or taken from the download cache if one is configured. Files
+    opened in place in lazy mode are not verified.
+
+    Files are downloaded concurrently when called from several threads, but
+    opened one at a time since the netCDF library is not thread-safe.
+
     Parameters:
         url (str): http url path to a netCDF file
+        lazy (bool): Whether to avoid copying the whole file when possible
+        sha256 (str): expected sha-256 hex digest of the file
 
     Returns:
         Dataset: Dataset object containing input netCDF file content
     """
+    if lazy:
+        parsed = urlparse(url)
+        if parsed.scheme in ("", "file"):
+            return _open_dataset(url2pathname(parsed.path))
+        elif is_opendap_url(url):
+            return _open_dataset(url)
+
+        try:
+            return _open_dataset(f"{url}#mode=bytes")
+        except OSError:
+            # No byte-range support in the server or netCDF library
+            pass
+
+    cached = _cached_object(url, sha256)
+    if cached:
+        return _open_dataset(cached)
+
     with NamedTemporaryFile(
         suffix=".nc", prefix="tmp_copy", dir="/tmp", delete=True
     ) as tmp_file:
-        data = Dataset(copy_http_content(url, tmp_file))
+        data = _open_dataset(copy_http_content(url, tmp_file, sha256=sha256))
 
     return data
 
 
-def json_to_dict(url):
+def _open_dataset(path):
+    with netcdf_lock:
+        return Dataset(path)
+
+
+def json_to_dict(url, sha256=None):
     """
     Access content from a json url file as a Python dictionary
 
     Parameters:
         url (str): file or http url path to a json file
+        sha256 (str): expected sha-256 hex digest of the file
 
     Returns:
         dictionary: Python dictionary with input json file's content
     """
+    cached = _cached_object(url, sha256)
+    if cached:
+        with open(cached, "rb") as json_file:
+            return json.load(json_file)
+
     with NamedTemporaryFile(
         suffix=".json", prefix="tmp_copy", dir="/tmp", delete=True
     ) as json_file:
-        urlretrieve(url, json_file.name)
+        download(url, json_file, expected_digest=sha256)
+        json_file.seek(0)
         dictionary = json.load(json_file)
 
     return dictionary
 
 
-def txt_to_string(url):
+def txt_to_string(url, sha256=None):
     """
     Access content from a txt url file as a string
 
     Parameters:
         url (str): file or http url path to a txt file
+        sha256 (str): expected sha-256 hex digest of the file
 
     Returns:
         string: content of the input txt file
     """
-    with urlopen(url) as text:
-        string = text.read().decode("utf-8")
+    cached = _cached_object(url, sha256)
+    if cached:
+        with open(cached, "rb") as text:
+            return text.read().decode("utf-8")
+
+    content = b"".join(_iter_chunks(url, 64 * 1024, sha256))
+    return content.decode("utf-8")
+
+
+def _cached_object(url, sha256):
+    """Path of the content of url in the download cache
+
+    Only contents with a known hash go through the cache, which then serves
+    them without a request if the same content was fetched before.
+    """
+    cache = get_download_cache()
+    if sha256 and cache and urlparse(url).scheme in ("http", "https"):
+        return cache.get(url, sha256)
+    return None
+
+
+def _iter_chunks(url, chunk_size, sha256=None):
+    """Stream the raw content of a file or http url in chunks
+
+    With sha256, the content is hashed as it is read and verified once it
+    has been read entirely.
+    """
+    hasher = hashlib.sha256() if sha256 else None
+    if urlparse(url).scheme in ("http", "https"):
+        with open_url(url) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if hasher:
+                    hasher.update(chunk)
+                yield chunk
+    else:
+        with urlopen(url) as source:
+            for chunk in iter(lambda: source.read(chunk_size), b""):
+                if hasher:
+                    hasher.update(chunk)
+                yield chunk
+
+    if hasher:
+        verify_digest(url, hasher.hexdigest(), sha256)
+
+
+def _iter_text(url, chunk_size, encoding, sha256=None):
+    decoder = codecs.getincrementaldecoder(encoding)()
+    for chunk in _iter_chunks(url, chunk_size, sha256):
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+def iter_text_lines(url, chunk_size=64 * 1024, encoding="utf-8", sha256=None):
+    """
+    Iterate over the lines of a txt url file, decoding it in chunks so
+    that memory use does not depend on the size of the file.
+
+    Parameters:
+        url (str): file or http url path to a txt file
+        chunk_size (int): number of bytes read at a time
+        encoding (str): encoding of the file
+        sha256 (str): expected sha-256 hex digest of the file, verified once
+            the last line has been read
+
+    Yields:
+        str: each line of the file, without its line ending
+    """
+    pending = ""
+    for text in _iter_text(url, chunk_size, encoding, sha256):
+        lines = (pending + text).split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line.rstrip("\r")
+    if pending:
+        yield pending.rstrip("\r")
+
+
+_json_whitespace = " \t\n\r"
+_json_number_chars = ("", *"0123456789.eE+-")
+
+
+def iter_json_items(url, chunk_size=64 * 1024, sha256=None):
+    """
+    Iterate over the items of a top-level json array, or the members of a
+    top-level json object, of a json url file. Only the item being decoded
+    is held in memory rather than the whole document.
 
-    return string
+    Parameters:
+        url (str): file or http url path to a json file
+        chunk_size (int): number of bytes read at a time
+        sha256 (str): expected sha-256 hex digest of the file, verified once
+            the last item has been read
+
+    Yields:
+        the items of an array, or (key, value) pairs of an object
+    """
+    decoder = json.JSONDecoder()
+    texts = _iter_text(url, chunk_size, "utf-8", sha256)
+    buffer = ""
+    pos = 0
+    eof = False
+
+    def fill(min_length=0):
+        """Read chunks until at least min_length characters are pending
+
+        The consumed part of the buffer is dropped. At least one chunk is
+        read, and False is returned if the end of the file was reached
+        before any could be.
+        """
+        nonlocal buffer, pos, eof
+        pieces = [buffer[pos:]]
+        length = len(pieces[0])
+        read = False
+        while not read or length < min_length:
+            text = next(texts, None)
+            if text is None:
+                eof = True
+                break
+            pieces.append(text)
+            length += len(text)
+            read = True
+        buffer = "".join(pieces)
+        pos = 0
+        return read
+
+    def peek():
+        """Skip whitespace and return the next character, "" at the end"""
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in _json_whitespace:
+                pos += 1
+            if pos < len(buffer) or not fill():
+                return buffer[pos : pos + 1]
+
+    def expect(chars):
+        nonlocal pos
+        char = peek()
+        if not char or char not in chars:
+            raise ValueError(
+                f"Expecting one of {chars!r} at {url}, found {char or 'end of file'!r}"
+            )
+        pos += 1
+        return char
+
+    def value():
+        """Decode the value starting at pos, reading more data as needed"""
+        nonlocal pos
+        peek()
+        while True:
+            try:
+                decoded, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Double the pending data before decoding again, so that a
+                # value spanning many chunks is decoded a logarithmic number
+                # of times rather than once per chunk
+                if not eof and fill(2 * (len(buffer) - pos)):
+                    continue
+                raise
+            if (
+                isinstance(decoded, (int, float))
+                and buffer[end : end + 1] in _json_number_chars
+                and not eof
+                and fill()
+            ):
+                # The number may continue in the next chunk
+                continue
+            pos = end
+            return decoded
+
+    opening = expect("[{")
+    closing = "]" if opening == "[" else "}"
+    if peek() == closing:
+        pos += 1
+    else:
+        while True:
+            if opening == "[":
+                yield value()
+            else:
+                key = value()
+                expect(":")
+                yield key, value()
+            if expect("," + closing) == closing:
+                break
+
+    if peek():
+        raise ValueError(f"Extra data after the top-level json value of {url}")
+    # Read to the end so that the hash, if any, is verified
+    for _ in texts:
+        pass
+
+
+def iter_metalink_content(url, chunk_size=64 * 1024):
+    """
+    Parse a metalink incrementally, yielding each file entry as soon as it
+    has been read. Memory use does not depend on the number of entries.
+
+    Parameters:
+        url (str): file or http url path to a meta4 (or metalink 3) file
+        chunk_size (int): number of bytes read at a time
+
+    Yields:
+        dict: "name", "size" (int or None), "hashes" (hash type to value)
+            and "urls" (metaurl entries, then url entries) of each file
+    """
+    parser = ElementTree.XMLPullParser(events=("start", "end"))
+    # Open elements, so that each file is dropped from its parent (the root
+    # in meta4, <files> in metalink 3) once read
+    open_elems = []
+
+    def entries():
+        for event, elem in parser.read_events():
+            if event == "start":
+                open_elems.append(elem)
+                continue
+
+            open_elems.pop()
+            if _local_name(elem.tag) == "file":
+                yield _metalink_entry(elem)
+                if open_elems:
+                    open_elems[-1].clear()
+
+    for chunk in _iter_chunks(url, chunk_size):
+        parser.feed(chunk)
+        yield from entries()
+
+    parser.close()
+    yield from entries()
+
+
+def _local_name(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+def _metalink_entry(file_elem):
+    entry = {"name": file_elem.get("name"), "size": None, "hashes": {}, "urls": []}
+    urls = []
+    for elem in file_elem.iter():
+        name = _local_name(elem.tag)
+        text = (elem.text or "").strip()
+        if name == "metaurl" and text:
+            entry["urls"].append(text)
+        elif name == "url" and text:
+            urls.append(text)
+        elif name == "size" and text:
+            entry["size"] = int(text)
+        elif name == "hash" and elem.get("type"):
+            entry["hashes"][elem.get("type")] = text
+    entry["urls"].extend(urls)
+    return entry
 
 
 def get_metalink_content(url):
     """
     Get a list of all the files from a metalink
 
+    Files listed with several urls (e.g. mirrors, or both a metaurl and a
+    url) are given by their first metaurl, or their first url if they have
+    no metaurl.
+
     Parameters:
         url (str): file or http url path to a meta4 file
 
     Returns:
-        list: a list of files
+        list: a list of files, one url per file
     """
+    return [entry["urls"][0] for entry in iter_metalink_content(url) if entry["urls"]]
+
 
-    req = requests.get(url)
-    metalinks = BeautifulSoup(
-        BeautifulSoup(req.content.decode("utf-8"), features="lxml").prettify(),
-        features="lxml",
-    ).find_all("metaurl")
+class OutputConstructionError(Exception):
+    """Raised when an output cannot be constructed from its url
 
-    return [
-        metalink.get_text().replace("\n", "").replace(" ", "") for metalink in metalinks
-    ]
+    Attributes:
+        url (str): url of the output that failed
+    """
 
+    def __init__(self, url, cause):
+        self.url = url
+        super().__init__(f"Unable to construct output from {url}: {cause}")
 
-def auto_construct_outputs(outputs):
+
+def construct_output(value, sha256=None, lazy=False):
     """
-    Automatically construct Python objects from input url files.
-    Written to construct complex WPS process Outputs.
+    Construct a Python object from a single output url, based on its extension.
+    Values that are not .nc, .json or .txt urls are returned as they are.
+
+    In lazy mode, .json and .txt files are returned as iterators over their
+    top-level items (see `iter_json_items`) and lines (see `iter_text_lines`)
+    that only read the file as they are consumed, and .nc files are opened
+    with `nc_to_dataset` in lazy mode.
+
     Parameters:
-        outputs (list): list of file or http url paths to files
+        value (str): file or http url path to a file
+        sha256 (str): expected sha-256 hex digest of the file, e.g. from a
+            metalink. A mismatch raises ChecksumMismatchError.
+        lazy (bool): whether to return iterators instead of loading files
     Returns:
-        list: the constructed python objects in a list
+        the constructed python object
     """
-    process_outputs = []
-    for value in outputs:
+    if value.endswith(".nc"):
+        return nc_to_dataset(value, lazy=lazy, sha256=sha256)
+
+    elif value.endswith(".json"):
+        if lazy:
+            return iter_json_items(value, sha256=sha256)
+        return json_to_dict(value, sha256=sha256)
+
+    elif value.endswith(".txt"):
+        if lazy:
+            return iter_text_lines(value, sha256=sha256)
+        return txt_to_string(value, sha256=sha256)
+
+    else:
+        return value
+
 
-        if value.endswith(".nc"):
-            output = nc_to_dataset(value)
+def _construct_output_reporting_url(output, lazy=False):
+    value, sha256 = output
+    try:
+        return construct_output(value, sha256, lazy)
+    except Exception as e:
+        raise OutputConstructionError(value, e) from e
 
-        elif value.endswith(".json"):
-            output = json_to_dict(value)
 
-        elif value.endswith(".txt"):
-            output = txt_to_string(value)
+def _metalink_sha256(entry):
+    """sha-256 hash of a metalink entry, as named by meta4 or metalink 3"""
+    return entry["hashes"].get("sha-256") or entry["hashes"].get("sha256")
 
-        elif value.endswith(".meta4"):
-            return auto_construct_outputs(get_metalink_content(value))
 
+def iter_output_urls(outputs):
+    """
+    Flatten metalinks in place: every .meta4 url is replaced, at its
+    position, by the urls it lists (recursively). Metalinks are only read
+    when the iteration reaches them.
+
+    Parameters:
+        outputs (iterable): file or http url paths to files
+    Yields:
+        str: the urls of the outputs
+    """
+    for value, _ in iter_output_entries(outputs):
+        yield value
+
+
+def iter_output_entries(outputs, sha256=None):
+    """
+    Like `iter_output_urls`, pairing each url with the sha-256 hash its
+    metalink lists for it.
+
+    Parameters:
+        outputs (iterable): file or http url paths to files
+        sha256 (str): hash of the outputs, if they were listed in a metalink
+    Yields:
+        tuple: the url of each output and its sha-256 hash, or None
+    """
+    for value in outputs:
+        if value.endswith(".meta4"):
+            for entry in iter_metalink_content(value):
+                # A single url per file, as in `get_metalink_content`
+                yield from iter_output_entries(
+                    entry["urls"][:1], _metalink_sha256(entry)
+                )
         else:
-            output = value
+            yield value, sha256
 
-        process_outputs.append(output)
 
-    return process_outputs
+def iter_construct_outputs(outputs, max_workers=None, lazy=False):
+    """
+    Construct Python objects from output url files one at a time, yielding
+    each as soon as it is ready. Metalinks are flattened in place, and
+    outputs after the point where the consumer stops iterating are never
+    fetched. Files listed with a sha-256 hash in a metalink are verified
+    while they are downloaded.
+    Parameters:
+        outputs (iterable): file or http url paths to files
+        max_workers (int): number of outputs fetched and constructed ahead
+            concurrently. The first failure is raised as an
+            OutputConstructionError holding its url.
+        lazy (bool): whether to construct json and txt outputs as iterators,
+            see `construct_output`
+    Yields:
+        the constructed python objects, in the order of outputs
+    """
+    entries = iter_output_entries(outputs)
+    if max_workers:
+        yield from imap_ordered(
+            functools.partial(_construct_output_reporting_url, lazy=lazy),
+            entries,
+            max_workers,
+        )
+    else:
+        for value, sha256 in entries:
+            yield construct_output(value, sha256, lazy)
+
+
+def auto_construct_outputs(outputs, max_workers=None, lazy=False):
+    """
+    Automatically construct Python objects from input url files.
+    Written to construct complex WPS process Outputs. Files listed in
+    metalinks replace the metalink at its position in the list.
+    Parameters:
+        outputs (list): list of file or http url paths to files
+        max_workers (int): number of outputs fetched and constructed
+            concurrently. The first failure is raised as an
+            OutputConstructionError holding its url.
+        lazy (bool): whether to construct json and txt outputs as iterators
+            over their items and lines, so that large outputs are not loaded
+            whole, see `construct_output`
+    Returns:
+        list: the constructed python objects in a list
+    """
+    return list(iter_construct_outputs(outputs, max_workers, lazy))
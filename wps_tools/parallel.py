@@ -0,0 +1,93 @@
+"""Bounded-concurrency helpers for network and disk bound work"""
+# Library imports
+import itertools
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from urllib.parse import urlparse
+
+
+def url_host(url):
+    """Return the host of a url, used to group requests by server"""
+    return urlparse(url).netloc
+
+
+def map_ordered(func, items, max_workers, group_limit=None, group=url_host):
+    """Apply func to every item in a thread pool and return results in order
+
+    The first exception raised by func cancels every call that has not started
+    yet and is re-raised once the calls still running have returned, so that
+    none of them is left writing files after the failure.
+
+    Parameters:
+        func (callable): Function called with each item
+        items (iterable): Items to process
+        max_workers (int): Maximum number of concurrent calls
+        group_limit (int): Maximum number of concurrent calls per group, e.g.
+            per host for urls. Unlimited if None.
+        group (callable): Function returning the group of an item
+
+    Returns:
+        list: func(item) for each item, in the order of items
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    if group_limit:
+        semaphores = defaultdict(lambda: threading.BoundedSemaphore(group_limit))
+        lock = threading.Lock()
+
+        def call(item):
+            with lock:
+                semaphore = semaphores[group(item)]
+            with semaphore:
+                return func(item)
+
+    else:
+        call = func
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = [executor.submit(call, item) for item in items]
+        done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in futures:
+            if future in done and future.exception():
+                raise future.exception()
+        return [future.result() for future in futures]
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def imap_ordered(func, items, max_workers):
+    """Lazily apply func to items in a thread pool, yielding results in order
+
+    At most max_workers calls are in flight, and items are only drawn from
+    the iterable as calls complete, so a consumer that stops iterating
+    leaves the remaining items unprocessed. The first exception raised by
+    func, in item order, cancels the pending calls and is re-raised.
+
+    Parameters:
+        func (callable): Function called with each item
+        items (iterable): Items to process, consumed lazily
+        max_workers (int): Maximum number of concurrent calls
+
+    Yields:
+        func(item) for each item, in the order of items
+    """
+    items = iter(items)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    pending = deque()
+    try:
+        for item in itertools.islice(items, max_workers):
+            pending.append(executor.submit(func, item))
+
+        while pending:
+            result = pending.popleft().result()
+            for item in itertools.islice(items, 1):
+                pending.append(executor.submit(func, item))
+            yield result
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
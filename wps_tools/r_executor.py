@@ -0,0 +1,480 @@
+"""Out-of-process pool of R workers
+
+The embedded R interpreter used by `wps_tools.R` is not thread-safe, so a
+process can only run one R job at a time. `RExecutor` runs R jobs in a pool of
+long-lived worker processes, each with its own embedded R and pre-imported
+packages, and returns `concurrent.futures.Future` objects.
+
+R objects returned by a job cannot be pickled, so they are saved by the worker
+to an .rds file in a transfer directory and returned as an `RObjectFile`.
+"""
+# Library imports
+import os
+import shutil
+import pickle
+import threading
+import itertools
+import multiprocessing
+from collections import deque
+from multiprocessing import connection
+from tempfile import mkdtemp
+from concurrent.futures import Future
+
+
+class BrokenWorkerError(RuntimeError):
+    """Raised when a worker process dies while running a job"""
+
+
+class RObjectFile:
+    """An R object produced by a worker and saved to an .rds file
+
+    Parameters:
+        path (str): Path of the .rds file
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, remove=True):
+        """Read the object into the embedded R of the current process
+
+        Parameters:
+            remove (bool): Whether to delete the .rds file afterwards
+
+        Returns:
+            Rpy2 object: the R object
+        """
+        from rpy2 import robjects
+
+        obj = robjects.r["readRDS"](self.path)
+        if remove:
+            os.remove(self.path)
+        return obj
+
+    def __repr__(self):
+        return f"RObjectFile({self.path!r})"
+
+
+def _import_package(package):
+    from wps_tools.R import get_package
+
+    get_package(package)
+    return package
+
+
+def _transfer(value, transfer_dir, task_id):
+    """Replace R objects by files so that value can be sent to the parent"""
+    try:
+        from rpy2.rinterface import Sexp
+    except ImportError:
+        return value
+
+    if not isinstance(value, Sexp):
+        return value
+
+    from rpy2 import robjects
+
+    path = os.path.join(transfer_dir, f"result_{os.getpid()}_{task_id}.rds")
+    robjects.r["saveRDS"](value, file=path)
+    return RObjectFile(path)
+
+
+def _picklable(error):
+    try:
+        pickle.dumps(error)
+        return error
+    except Exception:
+        return RuntimeError(f"{type(error).__name__}: {error}")
+
+
+def _worker(inbox, outbox, packages, max_tasks, transfer_dir):
+    """Main loop of a worker process
+
+    Jobs are received from inbox and messages sent to outbox, both pipes
+    owned by this worker alone: a worker killed at any point cannot leave
+    a lock held that would block the others.
+    """
+    pid = os.getpid()
+    if packages:
+        try:
+            from pywps.app.exceptions import ProcessError
+            from wps_tools.R import warm_packages
+
+            try:
+                warm_packages(packages)
+            except ProcessError:
+                # Missing packages are reported by the jobs that need them
+                # rather than by a worker crashing at start
+                pass
+        except BaseException as e:
+            # e.g. rpy2 is not installed or R fails to start: replacing the
+            # worker would fail the same way
+            outbox.send(("failed", pid, _picklable(e)))
+            return
+
+    outbox.send(("ready", pid))
+    for _ in range(max_tasks) if max_tasks else itertools.count():
+        task = inbox.recv()
+        if task is None:
+            break
+
+        task_id, fn, args, kwargs = task
+        try:
+            value = _transfer(fn(*args, **kwargs), transfer_dir, task_id)
+            outbox.send(("done", pid, task_id, value, None))
+        except BaseException as e:
+            outbox.send(("done", pid, task_id, None, _picklable(e)))
+
+    outbox.send(("retired", pid))
+
+
+class RExecutor:
+    """Pool of worker processes running R jobs
+
+    Workers are started with the "spawn" method so that none of them inherits
+    the embedded R of the parent. A worker is replaced by a fresh one after
+    max_tasks_per_worker jobs, which caps the growth of its R heap.
+
+    Each worker is handed one job at a time through its own pipe. A worker
+    that crashes or is killed is noticed as soon as it exits and replaced,
+    and only the job it was running fails, with BrokenWorkerError. A worker
+    that exits before it is ready to run jobs (e.g. because R or a package
+    cannot be loaded) breaks the executor instead: its workers are stopped
+    and every pending and later job fails with BrokenWorkerError.
+
+    Parameters:
+        max_workers (int): Number of worker processes
+        packages (list): R packages imported by every worker at start
+        max_tasks_per_worker (int): Jobs run by a worker before it is
+            recycled, unlimited if None
+        transfer_dir (str): Directory receiving R objects returned by jobs,
+            a temporary directory removed at shutdown if None
+    """
+
+    def __init__(
+        self, max_workers=2, packages=(), max_tasks_per_worker=100, transfer_dir=None
+    ):
+        self.max_workers = max_workers
+        self.packages = list(packages)
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self._own_transfer_dir = transfer_dir is None
+        self.transfer_dir = transfer_dir or mkdtemp(prefix="r_executor_")
+
+        self._context = multiprocessing.get_context("spawn")
+        self._lock = threading.Lock()
+        self._task_ids = itertools.count()
+        self._futures = {}
+        self._pending = deque()
+        # Per worker pid: process, pipe ends, job being run (or None) and
+        # number of jobs handed to it
+        self._workers = {}
+        self._inboxes = {}
+        self._outboxes = {}
+        self._assigned = {}
+        self._task_counts = {}
+        self._ready = set()
+        self._stopped = set()
+        self._shutdown = False
+        self._broken = None
+        # Wakes the collector up to notice a shutdown
+        self._wakeup, self._wakeup_writer = self._context.Pipe(duplex=False)
+
+        with self._lock:
+            for _ in range(max_workers):
+                self._spawn()
+
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    def submit(self, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) in a worker process
+
+        Parameters:
+            fn (callable): Picklable (module level) function
+            *args, **kwargs: Picklable arguments of fn
+
+        Returns:
+            concurrent.futures.Future: future resolving to the result of fn
+        """
+        with self._lock:
+            if self._broken:
+                raise BrokenWorkerError(str(self._broken))
+            if self._shutdown:
+                raise RuntimeError("Cannot submit jobs after shutdown")
+            task_id = next(self._task_ids)
+            future = Future()
+            self._futures[task_id] = future
+            self._pending.append((task_id, fn, args, kwargs))
+            self._dispatch()
+        return future
+
+    def load_rdata_to_python(self, r_file, r_object_name):
+        """Future of `wps_tools.R.load_rdata_to_python`, as an RObjectFile"""
+        from wps_tools.R import load_rdata_to_python
+
+        return self.submit(load_rdata_to_python, r_file, r_object_name)
+
+    def save_python_to_rdata(self, r_name, py_var, r_file):
+        """Future of `wps_tools.R.save_python_to_rdata`"""
+        from wps_tools.R import save_python_to_rdata
+
+        return self.submit(save_python_to_rdata, r_name, py_var, r_file)
+
+    def get_package(self, package):
+        """Future resolving to the package name once a worker imported it
+
+        Packages needed by every worker should rather be given to the
+        constructor.
+        """
+        return self.submit(_import_package, package)
+
+    def shutdown(self, wait=True, timeout=None):
+        """Stop the workers once the submitted jobs are done
+
+        Parameters:
+            wait (bool): Whether to block until the workers have exited
+            timeout (float): Seconds to wait before terminating the workers
+                still running, e.g. ones stuck at start. Jobs not done by
+                then fail with BrokenWorkerError. Unlimited if None.
+        """
+        with self._lock:
+            self._shutdown = True
+            self._dispatch()
+        self._wakeup_writer.send(None)
+
+        if wait:
+            self._collector.join(timeout)
+            if self._collector.is_alive():
+                self._break(BrokenWorkerError("Workers were terminated at shutdown"))
+                self._collector.join()
+            if self._own_transfer_dir:
+                shutil.rmtree(self.transfer_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown(wait=True)
+
+    def _spawn(self):
+        """Start a worker, with the lock held"""
+        inbox, inbox_writer = self._context.Pipe(duplex=False)
+        outbox_reader, outbox = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=_worker,
+            args=(
+                inbox,
+                outbox,
+                self.packages,
+                self.max_tasks_per_worker,
+                self.transfer_dir,
+            ),
+            daemon=True,
+        )
+        process.start()
+        # Only the worker keeps its ends, so that its exit closes the pipes
+        inbox.close()
+        outbox.close()
+
+        pid = process.pid
+        self._workers[pid] = process
+        self._inboxes[pid] = inbox_writer
+        self._outboxes[pid] = outbox_reader
+        self._assigned[pid] = None
+        self._task_counts[pid] = 0
+
+    def _remove(self, pid):
+        """Forget a worker that exited, with the lock held
+
+        Returns:
+            tuple: the process and the id of the job it was running, if any
+        """
+        process = self._workers.pop(pid)
+        self._inboxes.pop(pid).close()
+        self._outboxes.pop(pid).close()
+        self._task_counts.pop(pid)
+        self._ready.discard(pid)
+        self._stopped.discard(pid)
+        return process, self._assigned.pop(pid)
+
+    def _dispatch(self):
+        """Hand pending jobs to idle workers, with the lock held
+
+        Once shut down and out of jobs, idle workers are told to stop.
+        """
+        for pid, assigned in self._assigned.items():
+            if assigned is not None or pid in self._stopped:
+                continue
+            if (
+                self.max_tasks_per_worker
+                and self._task_counts[pid] >= self.max_tasks_per_worker
+            ):
+                # Retiring after its last job
+                continue
+
+            while self._pending:
+                task = self._pending.popleft()
+                future = self._futures.get(task[0])
+                if future is None or future.cancelled():
+                    self._futures.pop(task[0], None)
+                    continue
+
+                try:
+                    self._inboxes[pid].send(task)
+                except OSError:
+                    # Exited, its job is handed to another worker
+                    self._pending.appendleft(task)
+                    self._stopped.add(pid)
+                    break
+
+                future.set_running_or_notify_cancel()
+                self._assigned[pid] = task[0]
+                self._task_counts[pid] += 1
+                break
+
+            else:
+                if self._shutdown:
+                    try:
+                        self._inboxes[pid].send(None)
+                    except OSError:
+                        pass
+                    self._stopped.add(pid)
+
+    def _collect(self):
+        """Dispatch worker messages to futures and replace exited workers"""
+        while True:
+            with self._lock:
+                if self._shutdown and not self._workers:
+                    break
+                outboxes = {outbox: pid for pid, outbox in self._outboxes.items()}
+                sentinels = {
+                    process.sentinel: pid for pid, process in self._workers.items()
+                }
+
+            for ready in connection.wait([self._wakeup, *outboxes, *sentinels]):
+                if ready is self._wakeup:
+                    self._wakeup.recv()
+                elif ready in outboxes:
+                    self._receive(outboxes[ready], ready)
+                else:
+                    pid = sentinels[ready]
+                    # Messages sent before the worker exited come first
+                    with self._lock:
+                        outbox = self._outboxes.get(pid)
+                    while outbox is not None and self._receive(pid, outbox):
+                        pass
+                    self._exited(pid)
+
+        self._fail_pending(self._broken or RuntimeError("The executor was shut down"))
+
+    def _receive(self, pid, outbox):
+        """Handle the next message of a worker, if any
+
+        Returns:
+            bool: Whether a message was handled
+        """
+        try:
+            if outbox.closed or not outbox.poll():
+                return False
+            message = outbox.recv()
+        except (EOFError, OSError):
+            # The worker exited, which its sentinel reports
+            return False
+
+        kind = message[0]
+        if kind == "ready":
+            with self._lock:
+                self._ready.add(pid)
+
+        elif kind == "done":
+            _, pid, task_id, value, error = message
+            with self._lock:
+                future = self._futures.pop(task_id, None)
+                if self._assigned.get(pid) == task_id:
+                    self._assigned[pid] = None
+                self._dispatch()
+            if future is not None and not future.cancelled():
+                if error is None:
+                    future.set_result(value)
+                else:
+                    future.set_exception(error)
+
+        elif kind == "retired":
+            # A worker that ran its share of jobs is replaced, unless no job
+            # is left to run after shutdown
+            with self._lock:
+                process, _ = self._remove(pid)
+                if not self._broken and (not self._shutdown or self._pending):
+                    self._spawn()
+                self._dispatch()
+            process.join()
+
+        elif kind == "failed":
+            _, pid, error = message
+            with self._lock:
+                process, _ = self._remove(pid)
+            process.join()
+            self._break(BrokenWorkerError(f"Worker {pid} failed to start: {error}"))
+
+        return True
+
+    def _exited(self, pid):
+        """Fail the job of a worker that exited without retiring and replace it
+
+        A worker that exited before it was ready breaks the executor.
+        """
+        with self._lock:
+            if pid not in self._workers:
+                # Retired or failed, already handled
+                return
+            ready = pid in self._ready
+            process, task_id = self._remove(pid)
+            future = self._futures.pop(task_id, None)
+            broken = self._broken
+            if ready and not broken and (not self._shutdown or self._pending):
+                self._spawn()
+            self._dispatch()
+
+        process.join()
+        if future is not None and not future.cancelled():
+            future.set_exception(
+                BrokenWorkerError(
+                    f"Worker {pid} exited with code {process.exitcode} while "
+                    "running a job"
+                )
+            )
+        if not ready and not broken:
+            self._break(
+                BrokenWorkerError(
+                    f"Worker {pid} exited at start with code {process.exitcode}"
+                )
+            )
+
+    def _break(self, error):
+        """Stop every worker and fail the pending jobs with error"""
+        with self._lock:
+            if self._broken is None:
+                self._broken = error
+            self._shutdown = True
+            self._pending.clear()
+        self._terminate_workers()
+        self._fail_pending(self._broken)
+
+    def _terminate_workers(self):
+        with self._lock:
+            workers = list(self._workers.values())
+        for process in workers:
+            if process.is_alive():
+                process.terminate()
+
+    def _fail_pending(self, error):
+        with self._lock:
+            futures = list(self._futures.values())
+            self._futures.clear()
+            self._pending.clear()
+        for future in futures:
+            if not future.done():
+                if future.running() or isinstance(error, BrokenWorkerError):
+                    future.set_exception(error)
+                else:
+                    future.cancel()